@@ -0,0 +1,218 @@
+import os
+import time
+from collections import OrderedDict
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+
+class LRUCache(object):
+    """
+    A mapping that evicts its least recently used entries once the total size of the
+    values exceeds `max_size`. By default the size of a value is its length, so the
+    cache is bounded in bytes; pass `sizeof=lambda value: 1` to bound it by the
+    number of entries instead, or give both `max_size` and `max_entries`.
+    `on_evict(key, value)` is called for each entry evicted to make room.
+    """
+
+    def __init__(self, max_size, sizeof=len, on_evict=None, max_entries=None):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.on_evict = on_evict
+        self.max_entries = max_entries
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            return default
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        """
+        Add a value to the cache. Values larger than the whole cache aren't stored.
+        """
+        self.pop(key)
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return
+        self.entries[key] = value
+        self.size += size
+        while self.size > self.max_size or (self.max_entries is not None and len(self.entries) > self.max_entries):
+            evicted = next(iter(self.entries))
+            evicted_value = self.pop(evicted)
+            if self.on_evict is not None:
+                self.on_evict(evicted, evicted_value)
+
+    def pop(self, key, default=None):
+        if key not in self.entries:
+            return default
+        value = self.entries.pop(key)
+        self.size -= self.sizeof(value)
+        return value
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class DiskCache(object):
+    """
+    Keeps the files in a directory under `max_size` bytes in total by deleting the
+    least recently used ones.
+
+    Call `add` after a file is written to the directory and `touch` whenever one is
+    read. A file's modification time is used as the time it was last accessed, so
+    the order files are evicted in survives a restart.
+    """
+
+    def __init__(self, folder, max_size):
+        self.folder = folder
+        self.max_size = max_size
+        self.files = None
+
+    def add(self, name):
+        self._load()
+        try:
+            self.files.put(name, os.path.getsize(os.path.join(self.folder, name)))
+        except OSError:
+            self.files.pop(name)
+
+    def touch(self, name):
+        self._load()
+        try:
+            os.utime(os.path.join(self.folder, name), None)
+        except OSError:
+            self.files.pop(name)
+            return
+        if self.files.get(name) is None:
+            self.add(name)
+
+    def _load(self):
+        if self.files is not None:
+            return
+        self.files = LRUCache(self.max_size, sizeof=lambda size: size, on_evict=self._remove)
+        entries = []
+        if os.path.isdir(self.folder):
+            for name in os.listdir(self.folder):
+                try:
+                    stat = os.stat(os.path.join(self.folder, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, name, stat.st_size))
+        for mtime, name, size in sorted(entries):
+            self.files.put(name, size)
+
+    def _remove(self, name, size):
+        try:
+            os.remove(os.path.join(self.folder, name))
+        except OSError:
+            pass
+
+
+class RequestCoalescer(object):
+    """
+    Makes sure only one request for a given key is in progress at a time. Callers
+    asking for a key that's already being fetched get the result of that fetch
+    instead of starting their own.
+    """
+
+    def __init__(self):
+        self.pending = {}
+
+    def run(self, key, func, *args, **kw):
+        """
+        Calls `func(*args, **kw)` unless a call for `key` is already in progress.
+        Returns a `Deferred` that fires with the call's result.
+        """
+        d = defer.Deferred()
+        if key in self.pending:
+            self.pending[key].append(d)
+        else:
+            self.pending[key] = [d]
+            defer.maybeDeferred(func, *args, **kw).addBoth(self._fire, key)
+        return d
+
+    def _fire(self, result, key):
+        for d in self.pending.pop(key):
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+
+class StaleWhileRevalidateCache(object):
+    """
+    Caches protobuf objects fetched from other nodes (profiles, listings, followers
+    and so on), keyed by the kind of object and the node's guid.
+
+    A cached object is returned straight away. If it's more than `max_age` seconds
+    old it's also fetched again in the background so the next request gets the
+    update. Only a request for something that isn't cached at all waits on the
+    network. Parsed objects are kept in memory, bounded by `max_entries` and by
+    `max_size` bytes of serialized data. They're also written to `folder`, bounded by
+    `max_disk_size`, so the cache survives a restart.
+    """
+
+    def __init__(self, folder, max_age=300, max_entries=1000, max_size=16 * 1024 * 1024,
+                 max_disk_size=128 * 1024 * 1024):
+        self.folder = folder
+        self.max_age = max_age
+        self.memory = LRUCache(max_size, sizeof=lambda entry: len(entry[1]), max_entries=max_entries)
+        self.disk = DiskCache(folder, max_disk_size)
+        self.fetches = RequestCoalescer()
+
+    def get(self, kind, guid, fetch, proto_class):
+        """
+        Returns a `Deferred` that fires with the cached object or, if there isn't one,
+        with the result of `fetch`.
+        Args:
+            kind: the kind of object, e.g. `profile`.
+            guid: the hex encoded guid of the node the object is from.
+            fetch: a function returning a `Deferred` that fires with the object, or
+                `None` if it couldn't be fetched.
+            proto_class: the protobuf class of the object, to parse it from disk.
+        """
+        name = "%s_%s" % (kind, guid)
+        entry = self.memory.get(name)
+        if entry is None:
+            entry = self._load(name, proto_class)
+        if entry is None:
+            return self._fetch(name, fetch)
+        obj, ser, timestamp = entry
+        if time.time() - timestamp > self.max_age:
+            self._fetch(name, fetch).addErrback(lambda failure: None)
+        return defer.succeed(obj)
+
+    def _fetch(self, name, fetch):
+        def store(obj):
+            if obj is not None:
+                ser = obj.SerializeToString()
+                self.memory.put(name, (obj, ser, time.time()))
+                if not os.path.isdir(self.folder):
+                    os.makedirs(self.folder)
+                tmp_path = os.path.join(self.folder, name + ".tmp")
+                with open(tmp_path, 'wb') as outfile:
+                    outfile.write(ser)
+                os.rename(tmp_path, os.path.join(self.folder, name))
+                self.disk.add(name)
+            return obj
+        return self.fetches.run(name, lambda: fetch().addCallback(store))
+
+    def _load(self, name, proto_class):
+        file_path = os.path.join(self.folder, name)
+        try:
+            timestamp = os.path.getmtime(file_path)
+            with open(file_path, 'rb') as infile:
+                ser = infile.read()
+            obj = proto_class()
+            obj.ParseFromString(ser)
+        except Exception:
+            return None
+        entry = (obj, ser, timestamp)
+        self.memory.put(name, entry)
+        return entry
@@ -0,0 +1,118 @@
+import bisect
+import json
+import os
+import threading
+
+from constants import DATA_FOLDER
+
+
+class ChangeLog(object):
+    """
+    A persistent, append-only log of changes to the data the client keeps a copy of
+    (notifications, chat conversations, purchase and sale statuses and cases).
+
+    Every change is given a sequence number that keeps increasing across restarts.
+    A client that remembers the sequence number of the last change it saw only needs
+    to fetch what's changed since then instead of re-fetching every collection.
+
+    Only the latest change to each record is returned, so a record that changed many
+    times since the client's cursor is sent once. The log only keeps the most recent
+    changes: when it grows past twice `max_entries` it's compacted down to the latest
+    change to each record and then to the newest `max_entries` of those. A client
+    whose cursor is older than the changes that were dropped is told to re-fetch
+    everything instead.
+    """
+
+    def __init__(self, file_path, max_entries=10000):
+        self.file_path = file_path
+        self.max_entries = max_entries
+        self.sequence = 0
+        # changes up to and including this sequence number may have been dropped
+        self.floor = 0
+        self.entries = None
+        self.sequences = []
+        self.latest = {}
+        self._lock = threading.Lock()
+
+    def record(self, change_type, record_id, data=None):
+        """
+        Append a change to the log.
+        Args:
+            change_type: what kind of record changed, e.g. `notification`, `chat`,
+                `purchase`, `sale` or `case`.
+            record_id: the id of the record within that type.
+            data: a json serializable dict describing the change.
+        Returns: the sequence number of the change.
+        """
+        with self._lock:
+            self._load()
+            self.sequence += 1
+            entry = {"seq": self.sequence, "type": change_type, "id": record_id, "data": data or {}}
+            self._add(entry)
+            with open(self.file_path, 'a') as outfile:
+                outfile.write(json.dumps(entry) + "\n")
+            if len(self.entries) > 2 * self.max_entries:
+                self._compact()
+            return self.sequence
+
+    def get_changes(self, since=0, limit=None):
+        """
+        Returns the latest change to each record that has changed after the `since`
+        sequence number, oldest first, and the cursor to pass as `since` next time.
+        The changes are `None` if some of them are no longer in the log, in which case
+        the client should re-fetch everything and continue from the returned cursor.
+        """
+        with self._lock:
+            self._load()
+            if since < self.floor:
+                return None, self.sequence
+            changes = []
+            for entry in self.entries[bisect.bisect_right(self.sequences, since):]:
+                if self.latest[(entry["type"], entry["id"])] == entry["seq"]:
+                    changes.append(entry)
+                    if limit is not None and len(changes) == limit:
+                        return changes, entry["seq"]
+            return changes, self.sequence
+
+    def _add(self, entry):
+        self.entries.append(entry)
+        self.sequences.append(entry["seq"])
+        self.latest[(entry["type"], entry["id"])] = entry["seq"]
+
+    def _load(self):
+        if self.entries is not None:
+            return
+        self.entries = []
+        if os.path.isfile(self.file_path):
+            with open(self.file_path, 'r') as infile:
+                for line in infile:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a partially written last line
+                        continue
+                    if "floor" in entry:
+                        self.floor = self.sequence = entry["floor"]
+                    else:
+                        self._add(entry)
+                        self.sequence = entry["seq"]
+
+    def _compact(self):
+        entries = [e for e in self.entries if self.latest[(e["type"], e["id"])] == e["seq"]]
+        if len(entries) > self.max_entries:
+            self.floor = entries[-self.max_entries - 1]["seq"]
+            entries = entries[-self.max_entries:]
+        tmp_path = self.file_path + ".tmp"
+        with open(tmp_path, 'w') as outfile:
+            outfile.write(json.dumps({"floor": self.floor}) + "\n")
+            for entry in entries:
+                outfile.write(json.dumps(entry) + "\n")
+        os.rename(tmp_path, self.file_path)
+        self.entries = []
+        self.sequences = []
+        self.latest = {}
+        for entry in entries:
+            self._add(entry)
+
+
+change_log = ChangeLog(DATA_FOLDER + "changes.log")
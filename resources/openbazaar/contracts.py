@@ -3,6 +3,7 @@ __author__ = 'chris'
 
 import base64
 import bitcoin
+import hashlib
 import json
 import nacl.encoding
 import nacl.signing
@@ -20,11 +21,51 @@ from hashlib import sha256
 from keyutils.bip32utils import derive_childkey
 from keyutils.keys import KeyChain
 from log import Logger
-from urllib2 import Request, urlopen, URLError
+from market import events
+from market.changes import change_log
+from market.exchange_rates import exchange_rates, RateUnavailable
 from market.profile import Profile
 from market.utils import deserialize
 from protos.countries import CountryCode
 from protos.objects import Listings
+from twisted.internet import threads
+
+_listing_listeners = []
+
+
+def add_listing_listener(listener):
+    """
+    Register a callable to be notified whenever one of our listings is saved or deleted.
+    It's called with the `Contract` and the `ListingMetadata` that was saved, or `None`
+    if the listing was deleted.
+    """
+    _listing_listeners.append(listener)
+
+
+def load_listings(database):
+    """
+    Reads the metadata of all our listings from the `ListingsStore` along with the
+    keywords from each listing's contract. This opens every contract, so call it from
+    a worker thread.
+    Returns: a list of (`ListingMetadata`, keywords) tuples.
+    """
+    ser = database.ListingsStore().get_proto()
+    if ser is None:
+        return []
+    listings = Listings()
+    listings.ParseFromString(ser)
+    h = database.HashMap()
+    ret = []
+    for metadata in listings.listing:
+        keywords = []
+        try:
+            with open(h.get_file(metadata.contract_hash.encode("hex")), 'r') as filename:
+                contract = json.load(filename, object_pairs_hook=OrderedDict)
+            keywords = contract["vendor_offer"]["listing"]["item"].get("keywords", [])
+        except Exception:
+            pass
+        ret.append((metadata, keywords))
+    return ret
 
 
 class Contract(object):
@@ -56,21 +97,7 @@ class Contract(object):
                 with open(file_path, 'r') as filename:
                     self.contract = json.load(filename, object_pairs_hook=OrderedDict)
             except Exception:
-                if os.path.exists(DATA_FOLDER + "purchases/unfunded/" + hash_value.encode("hex") + ".json"):
-                    file_path = DATA_FOLDER + "purchases/unfunded/" + hash_value.encode("hex") + ".json"
-                elif os.path.exists(DATA_FOLDER + "purchases/in progress/" + hash_value.encode("hex") + ".json"):
-                    file_path = DATA_FOLDER + "purchases/in progress/" + hash_value.encode("hex") + ".json"
-                elif os.path.exists(DATA_FOLDER + "purchases/trade receipts/" + hash_value.encode("hex") + ".json"):
-                    file_path = DATA_FOLDER + "purchases/trade receipts/" + hash_value.encode("hex") + ".json"
-                elif os.path.exists(DATA_FOLDER + "store/contracts/unfunded/" + hash_value.encode("hex") + ".json"):
-                    file_path = DATA_FOLDER + "store/contracts/unfunded/" + hash_value.encode("hex") + ".json"
-                elif os.path.exists(DATA_FOLDER +
-                                    "store/contracts/in progress/" + hash_value.encode("hex") + ".json"):
-                    file_path = DATA_FOLDER + "store/contracts/in progress/" + hash_value.encode("hex") + ".json"
-                elif os.path.exists(DATA_FOLDER +
-                                    "store/contracts/trade receipts/" + hash_value.encode("hex") + ".json"):
-                    file_path = DATA_FOLDER + "store/contracts/trade receipts/" + hash_value.encode("hex") + ".json"
-
+                file_path = OrderIndex(self.db).get_file(hash_value.encode("hex"))
                 try:
                     with open(file_path, 'r') as filename:
                         self.contract = json.load(filename, object_pairs_hook=OrderedDict)
@@ -85,9 +112,44 @@ class Contract(object):
         self.notification_listener = None
         self.blockchain = None
         self.amount_funded = 0
-        self.received_txs = []
         self.is_purchase = False
         self.outpoints = []
+        self.funded_outpoints = None
+        self.funding_watcher = None
+
+    @property
+    def contract(self):
+        return self._contract
+
+    @contract.setter
+    def contract(self, value):
+        self._contract = value
+        self.invalidate()
+
+    def set_section(self, name, value):
+        """
+        Set a top-level section of the contract (`buyer_order`, `buyer_receipt`, etc.)
+        and drop the cached serialization.
+        """
+        self._contract[name] = value
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Drop the cached serialization and contract id. Anything that mutates
+        `self.contract` in place, rather than through `set_section`, must call this.
+        """
+        self._serialized = None
+        self._contract_id = None
+
+    def serialize(self):
+        """
+        Returns the json serialization of the contract. This is what we hash, sign
+        and write to disk so it's computed once and cached until the contract changes.
+        """
+        if self._serialized is None:
+            self._serialized = json.dumps(self._contract, indent=4)
+        return self._serialized
 
     def create(self,
                expiration_date,
@@ -114,7 +176,8 @@ class Contract(object):
                shipping_domestic=None,
                shipping_international=None,
                options=None,
-               moderators=None):
+               moderators=None,
+               commit=True):
         """
         All parameters are strings except:
         :param expiration_date: `string` (must be formatted UTC datetime)
@@ -126,6 +189,8 @@ class Contract(object):
         :param shipping_regions: a 'list' of 'string' formatted `CountryCode`s
         :param options: a 'dict' containing options as keys and 'list' as option values.
         :param moderators: a 'list' of 'string' guids (hex encoded).
+        :param commit: `boolean` sign and save the listing. If `False` the contract is only
+            built so that a batch of listings can be signed together and saved afterwards.
         """
 
         profile = Profile(self.db).get()
@@ -257,14 +322,18 @@ class Contract(object):
                     }
                     self.contract["vendor_offer"]["listing"]["moderators"].append(moderator)
 
-        listing = json.dumps(self.contract["vendor_offer"]["listing"], indent=4)
-        self.contract["vendor_offer"]["signatures"] = {}
-        self.contract["vendor_offer"]["signatures"]["guid"] = \
-            base64.b64encode(self.keychain.signing_key.sign(listing)[:64])
-        self.contract["vendor_offer"]["signatures"]["bitcoin"] = \
-            bitcoin.encode_sig(*bitcoin.ecdsa_raw_sign(
-                listing, bitcoin.bip32_extract_key(self.keychain.bitcoin_master_privkey)))
-        self.save()
+        if commit:
+            listing = json.dumps(self.contract["vendor_offer"]["listing"], indent=4)
+            self.set_listing_signatures(sign_listing(listing, self.keychain.signing_key.encode(),
+                                                     bitcoin.bip32_extract_key(self.keychain.bitcoin_master_privkey)))
+            self.save()
+
+    def set_listing_signatures(self, signatures):
+        """
+        Attach the `vendor_offer` signatures returned by `sign_listing`.
+        """
+        self.contract["vendor_offer"]["signatures"] = signatures
+        self.invalidate()
 
     def add_purchase_info(self,
                           quantity,
@@ -295,7 +364,7 @@ class Contract(object):
         order_json = {
             "buyer_order": {
                 "order": {
-                    "ref_hash": digest(json.dumps(self.contract, indent=4)).encode("hex"),
+                    "ref_hash": self.get_contract_id().encode("hex"),
                     "date": str(datetime.utcnow()) + " UTC",
                     "quantity": quantity,
                     "id": {
@@ -367,12 +436,9 @@ class Contract(object):
             currency_code = price_json["fiat"]["currency_code"]
             fiat_price = price_json["fiat"]["price"]
             try:
-                request = Request('https://api.bitcoinaverage.com/ticker/' + currency_code.upper() + '/last')
-                response = urlopen(request)
-                conversion_rate = response.read()
-            except URLError:
+                amount_to_pay = exchange_rates.to_btc(fiat_price, currency_code) * quantity
+            except RateUnavailable:
                 return False
-            amount_to_pay = float("{0:.8f}".format(float(fiat_price) / float(conversion_rate))) * quantity
         if "shipping" in self.contract["vendor_offer"]["listing"]:
             if not self.contract["vendor_offer"]["listing"]["shipping"]["free"]:
                 shipping_origin = str(self.contract["vendor_offer"]["listing"]["shipping"][
@@ -387,12 +453,9 @@ class Contract(object):
                         currency = self.contract["vendor_offer"]["listing"]["shipping"]["flat_fee"][
                             "fiat"]["currency_code"]
                         try:
-                            request = Request('https://api.bitcoinaverage.com/ticker/' + currency.upper() + '/last')
-                            response = urlopen(request)
-                            conversion_rate = response.read()
-                        except URLError:
+                            shipping_amount = exchange_rates.to_btc(price, currency) * quantity
+                        except RateUnavailable:
                             return False
-                        shipping_amount = float("{0:.8f}".format(float(price) / float(conversion_rate))) * quantity
                 else:
                     if "bitcoin" in self.contract["vendor_offer"]["listing"]["shipping"]["flat_fee"]:
                         shipping_amount = float(self.contract["vendor_offer"]["listing"]["shipping"][
@@ -403,28 +466,33 @@ class Contract(object):
                         currency = self.contract["vendor_offer"]["listing"]["shipping"]["flat_fee"][
                             "fiat"]["currency_code"]
                         try:
-                            request = Request('https://api.bitcoinaverage.com/ticker/' + currency.upper() + '/last')
-                            response = urlopen(request)
-                            conversion_rate = response.read()
-                        except URLError:
+                            shipping_amount = exchange_rates.to_btc(price, currency) * quantity
+                        except RateUnavailable:
                             return False
-                        shipping_amount = float("{0:.8f}".format(float(price) / float(conversion_rate))) * quantity
                 amount_to_pay += shipping_amount
 
         order_json["buyer_order"]["order"]["payment"]["amount"] = round(amount_to_pay, 8)
-        self.contract["buyer_order"] = order_json["buyer_order"]
 
-        order = json.dumps(self.contract["buyer_order"]["order"], indent=4)
-        self.contract["buyer_order"]["signatures"] = {}
-        self.contract["buyer_order"]["signatures"]["guid"] = \
+        order = json.dumps(order_json["buyer_order"]["order"], indent=4)
+        order_json["buyer_order"]["signatures"] = {}
+        order_json["buyer_order"]["signatures"]["guid"] = \
             base64.b64encode(self.keychain.signing_key.sign(order)[:64])
-        self.contract["buyer_order"]["signatures"]["bitcoin"] = \
+        order_json["buyer_order"]["signatures"]["bitcoin"] = \
             bitcoin.encode_sig(*bitcoin.ecdsa_raw_sign(
                 order, bitcoin.bip32_extract_key(self.keychain.bitcoin_master_privkey)))
+        self.set_section("buyer_order", order_json["buyer_order"])
 
         return (self.contract["buyer_order"]["order"]["payment"]["address"],
                 order_json["buyer_order"]["order"]["payment"]["amount"])
 
+    def add_purchase_info_async(self, *args, **kwargs):
+        """
+        Same as `add_purchase_info` but runs in the reactor's thread pool so the exchange
+        rate lookup and signing don't block the reactor. Returns a `Deferred` that fires
+        with the result of `add_purchase_info`.
+        """
+        return threads.deferToThread(self.add_purchase_info, *args, **kwargs)
+
     def add_order_confirmation(self,
                                libbitcoin_client,
                                payout_address,
@@ -450,7 +518,7 @@ class Contract(object):
         conf_json = {
             "vendor_order_confirmation": {
                 "invoice": {
-                    "ref_hash": digest(json.dumps(self.contract, indent=4)).encode("hex")
+                    "ref_hash": self.get_contract_id().encode("hex")
                 }
             }
         }
@@ -462,7 +530,7 @@ class Contract(object):
             conf_json["vendor_order_confirmation"]["invoice"]["content_source"] = content_source
         if comments:
             conf_json["vendor_order_confirmation"]["invoice"]["comments"] = comments
-        order_id = digest(json.dumps(self.contract, indent=4)).encode("hex")
+        order_id = self.get_contract_id().encode("hex")
         # apply signatures
         outpoints = pickle.loads(self.db.Sales().get_outpoint(order_id))
         if "moderator" in self.contract["buyer_order"]["order"]:
@@ -506,11 +574,12 @@ class Contract(object):
         conf_json["vendor_order_confirmation"]["signature"] = \
             base64.b64encode(self.keychain.signing_key.sign(confirmation)[:64])
 
-        self.contract["vendor_order_confirmation"] = conf_json["vendor_order_confirmation"]
+        self.set_section("vendor_order_confirmation", conf_json["vendor_order_confirmation"])
         self.db.Sales().update_status(order_id, 2)
-        file_path = DATA_FOLDER + "store/contracts/in progress/" + order_id + ".json"
+        change_log.record("sale", order_id, {"status": 2})
+        file_path = OrderIndex(self.db).update(order_id, False, "in progress")
         with open(file_path, 'w') as outfile:
-            outfile.write(json.dumps(self.contract, indent=4))
+            outfile.write(self.serialize())
 
     def accept_order_confirmation(self, notification_listener, confirmation_json=None):
         """
@@ -519,12 +588,10 @@ class Contract(object):
         self.notification_listener = notification_listener
         try:
             if confirmation_json:
-                self.contract["vendor_order_confirmation"] = json.loads(confirmation_json,
-                                                                        object_pairs_hook=OrderedDict)
+                self.set_section("vendor_order_confirmation", json.loads(confirmation_json,
+                                                                         object_pairs_hook=OrderedDict))
 
-            contract_dict = json.loads(json.dumps(self.contract, indent=4), object_pairs_hook=OrderedDict)
-            del contract_dict["vendor_order_confirmation"]
-            contract_hash = digest(json.dumps(contract_dict, indent=4)).encode("hex")
+            contract_hash = self.digest_without("vendor_order_confirmation").encode("hex")
             ref_hash = self.contract["vendor_order_confirmation"]["invoice"]["ref_hash"]
             if ref_hash != contract_hash:
                 raise Exception("Order number doesn't match")
@@ -542,11 +609,12 @@ class Contract(object):
 
             # update the order status in the db
             purchase_db.update_status(contract_hash, 2)
-            file_path = DATA_FOLDER + "purchases/in progress/" + contract_hash + ".json"
+            change_log.record("purchase", contract_hash, {"status": 2})
+            file_path = OrderIndex(self.db).update(contract_hash, True, "in progress")
 
             # update the contract in the file system
             with open(file_path, 'w') as outfile:
-                outfile.write(json.dumps(self.contract, indent=4))
+                outfile.write(self.serialize())
             title = self.contract["vendor_offer"]["listing"]["item"]["title"]
             if "image_hashes" in self.contract["vendor_offer"]["listing"]["item"]:
                 image_hash = unhexlify(self.contract["vendor_offer"]["listing"]["item"]["image_hashes"][0])
@@ -557,8 +625,8 @@ class Contract(object):
             else:
                 handle = ""
             vendor_guid = self.contract["vendor_offer"]["listing"]["id"]["guid"]
-            self.notification_listener.notify(vendor_guid, handle, "order confirmation", contract_hash, title,
-                                              image_hash)
+            events.notify(self.notification_listener, unhexlify(vendor_guid), handle, "order confirmation",
+                          contract_hash, title, image_hash)
             return contract_hash
         except Exception:
             return False
@@ -583,7 +651,7 @@ class Contract(object):
         receipt_json = {
             "buyer_receipt": {
                 "receipt": {
-                    "ref_hash": digest(json.dumps(self.contract, indent=4)).encode("hex"),
+                    "ref_hash": self.get_contract_id().encode("hex"),
                     "listing": {
                         "received": received,
                         "listing_hash": self.contract["buyer_order"]["order"]["ref_hash"]
@@ -640,12 +708,13 @@ class Contract(object):
         receipt = json.dumps(receipt_json["buyer_receipt"]["receipt"], indent=4)
         receipt_json["buyer_receipt"]["signature"] = \
             base64.b64encode(self.keychain.signing_key.sign(receipt)[:64])
-        self.contract["buyer_receipt"] = receipt_json["buyer_receipt"]
+        self.set_section("buyer_receipt", receipt_json["buyer_receipt"])
         self.db.Purchases().update_status(order_id, 3)
-        file_path = DATA_FOLDER + "purchases/trade receipts/" + order_id + ".json"
+        change_log.record("purchase", order_id, {"status": 3})
+        file_path = OrderIndex(self.db).update(order_id, True, "trade receipts")
         with open(file_path, 'w') as outfile:
-            outfile.write(json.dumps(self.contract, indent=4))
-        file_path = DATA_FOLDER + "purchases/in progress/" + order_id + ".json"
+            outfile.write(self.serialize())
+        file_path = order_path(order_id, True, "in progress")
         if os.path.exists(file_path):
             os.remove(file_path)
 
@@ -657,11 +726,9 @@ class Contract(object):
         self.notification_listener = notification_listener
         self.blockchain = blockchain
         if receipt_json:
-            self.contract["buyer_receipt"] = json.loads(receipt_json,
-                                                        object_pairs_hook=OrderedDict)
-        contract_dict = json.loads(json.dumps(self.contract, indent=4), object_pairs_hook=OrderedDict)
-        del contract_dict["buyer_receipt"]
-        contract_hash = digest(json.dumps(contract_dict, indent=4)).encode("hex")
+            self.set_section("buyer_receipt", json.loads(receipt_json,
+                                                         object_pairs_hook=OrderedDict))
+        contract_hash = self.digest_without("buyer_receipt").encode("hex")
         ref_hash = self.contract["buyer_receipt"]["receipt"]["ref_hash"]
         if ref_hash != contract_hash:
             raise Exception("Order number doesn't match")
@@ -718,13 +785,15 @@ class Contract(object):
                 handle = self.contract["buyer_order"]["order"]["id"]["blockchain_id"]
             else:
                 handle = ""
-            self.notification_listener.notify(buyer_guid, handle, "payment received", order_id, title, image_hash)
+            events.notify(self.notification_listener, unhexlify(buyer_guid), handle, "payment received",
+                          order_id, title, image_hash)
 
         self.db.Sales().update_status(order_id, 3)
-        file_path = DATA_FOLDER + "store/contracts/trade receipts/" + order_id + ".json"
+        change_log.record("sale", order_id, {"status": 3})
+        file_path = OrderIndex(self.db).update(order_id, False, "trade receipts")
         with open(file_path, 'w') as outfile:
-            outfile.write(json.dumps(self.contract, indent=4))
-        file_path = DATA_FOLDER + "store/contracts/in progress/" + order_id + ".json"
+            outfile.write(self.serialize())
+        file_path = order_path(order_id, False, "in progress")
         if os.path.exists(file_path):
             os.remove(file_path)
 
@@ -735,11 +804,13 @@ class Contract(object):
         Saves the contract to the file system and db as an unfunded contract.
         Listens on the libbitcoin server for the multisig address to be funded.
         """
+        # imported here since market.funding depends on this module
+        from market.funding import get_watcher
 
         self.notification_listener = notification_listener
         self.blockchain = libbitcoin_client
         self.is_purchase = is_purchase
-        order_id = digest(json.dumps(self.contract, indent=4)).encode("hex")
+        order_id = self.get_contract_id().encode("hex")
         payment_address = self.contract["buyer_order"]["order"]["payment"]["address"]
         vendor_item = self.contract["vendor_offer"]["listing"]["item"]
         if "image_hashes" in vendor_item:
@@ -756,8 +827,8 @@ class Contract(object):
             buyer = self.contract["buyer_order"]["order"]["id"]["blockchain_id"]
         else:
             buyer = self.contract["buyer_order"]["order"]["id"]["guid"]
+        file_path = OrderIndex(self.db).update(order_id, is_purchase, "unfunded")
         if is_purchase:
-            file_path = DATA_FOLDER + "purchases/unfunded/" + order_id + ".json"
             self.db.Purchases().new_purchase(order_id,
                                              self.contract["vendor_offer"]["listing"]["item"]["title"],
                                              self.contract["vendor_offer"]["listing"]["item"]["description"],
@@ -769,8 +840,8 @@ class Contract(object):
                                              vendor,
                                              proofSig,
                                              self.contract["vendor_offer"]["listing"]["metadata"]["category"])
+            change_log.record("purchase", order_id, {"status": 0})
         else:
-            file_path = DATA_FOLDER + "store/contracts/unfunded/" + order_id + ".json"
             self.db.Sales().new_sale(order_id,
                                      self.contract["vendor_offer"]["listing"]["item"]["title"],
                                      self.contract["vendor_offer"]["listing"]["item"]["description"],
@@ -781,10 +852,12 @@ class Contract(object):
                                      thumbnail_hash,
                                      buyer,
                                      self.contract["vendor_offer"]["listing"]["metadata"]["category"])
+            change_log.record("sale", order_id, {"status": 0})
 
         with open(file_path, 'w') as outfile:
-            outfile.write(json.dumps(self.contract, indent=4))
-        self.blockchain.subscribe_address(str(payment_address), notification_cb=self.on_tx_received)
+            outfile.write(self.serialize())
+        get_watcher(self.db, self.blockchain, notification_listener, self.testnet)\
+            .watch(payment_address, order_id, is_purchase)
 
     def on_tx_received(self, address_version, address_hash, height, block_hash, tx):
         """
@@ -792,6 +865,10 @@ class Contract(object):
         While unlikely, a user may send multiple transactions to the funding address to reach the
         funding level. We need to keep a running balance and increment it when a new transaction
         is received. If the contract is fully funded, we push a notification to the websockets.
+
+        The outputs paying us are recorded by txid:vout, so an output seen twice (for example
+        from both the subscription and a rescan) is only counted once. They're saved with the
+        order after every transaction that adds one, so partial funding survives a restart.
         """
         try:
             # decode the transaction
@@ -800,64 +877,99 @@ class Contract(object):
 
             # get the amount (in satoshi) the user is expected to pay
             amount_to_pay = int(float(self.contract["buyer_order"]["order"]["payment"]["amount"]) * 100000000)
-            if tx not in self.received_txs:  # make sure we aren't parsing the same tx twice.
-                if "moderator" in self.contract["buyer_order"]["order"]:
-                    output_script = 'a914' + digest(unhexlify(
-                        self.contract["buyer_order"]["order"]["payment"]["redeem_script"])).encode("hex") + '87'
-                else:
-                    output_script = '76a914' + bitcoin.b58check_to_hex(
-                        self.contract["buyer_order"]["order"]["payment"]["address"]) +'88ac'
-                for output in transaction["outs"]:
-                    if output["script"] == output_script:
+            order_id = self.get_contract_id().encode("hex")
+            order_db = self.db.Purchases() if self.is_purchase else self.db.Sales()
+            if self.funded_outpoints is None:
+                self._load_funding(order_db, order_id)
+            if "moderator" in self.contract["buyer_order"]["order"]:
+                output_script = 'a914' + digest(unhexlify(
+                    self.contract["buyer_order"]["order"]["payment"]["redeem_script"])).encode("hex") + '87'
+            else:
+                output_script = '76a914' + bitcoin.b58check_to_hex(
+                    self.contract["buyer_order"]["order"]["payment"]["address"]) +'88ac'
+            txid = None
+            funded = len(self.outpoints)
+            for output in transaction["outs"]:
+                if output["script"] == output_script:
+                    txid = txid or bitcoin.txhash(tx.encode("hex"))
+                    outpoint = txid + ":" + str(output["index"])
+                    if outpoint not in self.funded_outpoints:  # make sure we don't count an output twice
+                        self.funded_outpoints.add(outpoint)
+                        self.outpoints.append({"output": outpoint, "value": output["value"]})
                         self.amount_funded += output["value"]
-                        if tx not in self.received_txs:
-                            self.received_txs.append(tx)
-                        self.outpoints.append({"output": bitcoin.txhash(tx.encode("hex")) +
-                                                         ":" + str(output["index"]), "value": output["value"]})
-                if self.amount_funded >= amount_to_pay:  # if fully funded
+            if len(self.outpoints) > funded:
+                order_db.update_outpoint(order_id, pickle.dumps(self.outpoints))
+
+            # if fully funded and we haven't already moved the order on
+            if self.amount_funded >= amount_to_pay and \
+                    OrderIndex(self.db).get_state(order_id) == (self.is_purchase, "unfunded"):
+                if self.funding_watcher is not None:
+                    self.funding_watcher.unwatch(self.contract["buyer_order"]["order"]["payment"]["address"])
+                else:
                     self.blockchain.unsubscribe_address(
                         self.contract["buyer_order"]["order"]["payment"]["address"], self.on_tx_received)
-                    order_id = digest(json.dumps(self.contract, indent=4)).encode("hex")
-                    title = self.contract["vendor_offer"]["listing"]["item"]["title"]
-                    if "image_hashes" in self.contract["vendor_offer"]["listing"]["item"]:
-                        image_hash = unhexlify(self.contract["vendor_offer"]["listing"]["item"]["image_hashes"][0])
+                title = self.contract["vendor_offer"]["listing"]["item"]["title"]
+                if "image_hashes" in self.contract["vendor_offer"]["listing"]["item"]:
+                    image_hash = unhexlify(self.contract["vendor_offer"]["listing"]["item"]["image_hashes"][0])
+                else:
+                    image_hash = ""
+                if self.is_purchase:
+                    if "blockchain_id" in self.contract["vendor_offer"]["listing"]["id"]:
+                        handle = self.contract["vendor_offer"]["listing"]["id"]["blockchain_id"]
                     else:
-                        image_hash = ""
-                    if self.is_purchase:
-                        unfunded_path = DATA_FOLDER + "purchases/unfunded/" + order_id + ".json"
-                        in_progress_path = DATA_FOLDER + "purchases/in progress/" + order_id + ".json"
-                        if "blockchain_id" in self.contract["vendor_offer"]["listing"]["id"]:
-                            handle = self.contract["vendor_offer"]["listing"]["id"]["blockchain_id"]
-                        else:
-                            handle = ""
-                        vendor_guid = self.contract["vendor_offer"]["listing"]["id"]["guid"]
-                        self.notification_listener.notify(unhexlify(vendor_guid), handle, "payment received",
-                                                          order_id, title, image_hash)
-                        # update the db
-                        self.db.Purchases().update_status(order_id, 1)
-                        self.db.Purchases().update_outpoint(order_id, pickle.dumps(self.outpoints))
-                        self.log.info("Payment for order id %s successfully broadcast to network." % order_id)
+                        handle = ""
+                    vendor_guid = self.contract["vendor_offer"]["listing"]["id"]["guid"]
+                    events.notify(self.notification_listener, unhexlify(vendor_guid), handle,
+                                  "payment received", order_id, title, image_hash)
+                    # update the db
+                    self.db.Purchases().update_status(order_id, 1)
+                    change_log.record("purchase", order_id, {"status": 1})
+                    self.log.info("Payment for order id %s successfully broadcast to network." % order_id)
+                else:
+                    buyer_guid = self.contract["buyer_order"]["order"]["id"]["guid"]
+                    if "blockchain_id" in self.contract["buyer_order"]["order"]["id"]:
+                        handle = self.contract["buyer_order"]["order"]["id"]["blockchain_id"]
                     else:
-                        unfunded_path = DATA_FOLDER + "store/contracts/unfunded/" + order_id + ".json"
-                        in_progress_path = DATA_FOLDER + "store/contracts/in progress/" + order_id + ".json"
-                        buyer_guid = self.contract["buyer_order"]["order"]["id"]["guid"]
-                        if "blockchain_id" in self.contract["buyer_order"]["order"]["id"]:
-                            handle = self.contract["buyer_order"]["order"]["id"]["blockchain_id"]
-                        else:
-                            handle = ""
-                        self.notification_listener.notify(unhexlify(buyer_guid), handle, "new order", order_id,
-                                                          title, image_hash)
-                        self.db.Sales().update_status(order_id, 1)
-                        self.db.Sales().update_outpoint(order_id, pickle.dumps(self.outpoints))
-                        self.log.info("Received new order %s" % order_id)
-
-                    os.rename(unfunded_path, in_progress_path)
+                        handle = ""
+                    events.notify(self.notification_listener, unhexlify(buyer_guid), handle,
+                                  "new order", order_id, title, image_hash)
+                    self.db.Sales().update_status(order_id, 1)
+                    change_log.record("sale", order_id, {"status": 1})
+                    self.log.info("Received new order %s" % order_id)
+
+                os.rename(order_path(order_id, self.is_purchase, "unfunded"),
+                          order_path(order_id, self.is_purchase, "in progress"))
+                OrderIndex(self.db).update(order_id, self.is_purchase, "in progress")
         except Exception:
             self.log.critical("Error processing bitcoin transaction")
 
+    def _load_funding(self, order_db, order_id):
+        """
+        Load the outputs that have paid this order so far, saved by `on_tx_received`.
+        """
+        ser = order_db.get_outpoint(order_id)
+        self.outpoints = pickle.loads(ser) if ser else []
+        self.funded_outpoints = set(o["output"] for o in self.outpoints)
+        self.amount_funded = sum(o["value"] for o in self.outpoints)
+
     def get_contract_id(self):
-        contract = json.dumps(self.contract, indent=4)
-        return digest(contract)
+        if self._contract_id is None:
+            self._contract_id = digest(self.serialize())
+        return self._contract_id
+
+    def digest_without(self, *sections):
+        """
+        Returns the hash the contract would have with the given top-level sections
+        removed, i.e. the hash the counterparty referenced before appending their
+        section. Only the top level is copied and the json is fed into the hash as
+        it's encoded, so this gives the same result as `digest` over a pruned deep
+        copy without building one.
+        """
+        pruned = OrderedDict((k, v) for k, v in self.contract.items() if k not in sections)
+        h = sha256()
+        for chunk in json.JSONEncoder(indent=4).iterencode(pruned):
+            h.update(chunk)
+        return hashlib.new("ripemd160", h.digest()).digest()
 
     def delete(self, delete_images=False):
         """
@@ -867,7 +979,7 @@ class Contract(object):
 
         # get the file path
         h = self.db.HashMap()
-        file_path = h.get_file(digest(json.dumps(self.contract, indent=4)).encode("hex"))
+        file_path = h.get_file(self.get_contract_id().encode("hex"))
 
         # maybe delete the images from disk
         if "image_hashes" in self.contract["vendor_offer"]["listing"]["item"] and delete_images:
@@ -884,12 +996,14 @@ class Contract(object):
             os.remove(file_path)
 
         # delete the listing metadata from the db
-        contract_hash = digest(json.dumps(self.contract, indent=4))
+        contract_hash = self.get_contract_id()
         self.db.ListingsStore().delete_listing(contract_hash)
 
         # remove the pointer to the contract from the HashMap
         h.delete(contract_hash.encode("hex"))
 
+        self._notify_listing_listeners(None)
+
     def save(self):
         """
         Saves the json contract into the OpenBazaar/store/listings/contracts/ directory.
@@ -904,17 +1018,17 @@ class Contract(object):
         file_name = str(self.contract["vendor_offer"]["listing"]["item"]["title"][:100])
         file_name = re.sub(r"[^\w\s]", '', file_name)
         file_name = re.sub(r"\s+", '_', file_name)
-        file_name += digest(json.dumps(self.contract, indent=4)).encode("hex")[:8]
+        file_name += self.get_contract_id().encode("hex")[:8]
 
         # save the json contract to the file system
         file_path = DATA_FOLDER + "store/contracts/listings/" + file_name + ".json"
         with open(file_path, 'w') as outfile:
-            outfile.write(json.dumps(self.contract, indent=4))
+            outfile.write(self.serialize())
 
         # Create a `ListingMetadata` protobuf object using data from the full contract
         listings = Listings()
         data = listings.ListingMetadata()
-        data.contract_hash = digest(json.dumps(self.contract, indent=4))
+        data.contract_hash = self.get_contract_id()
         vendor_item = self.contract["vendor_offer"]["listing"]["item"]
         data.title = vendor_item["title"]
         if "image_hashes" in vendor_item:
@@ -943,15 +1057,22 @@ class Contract(object):
         # save the `ListingMetadata` protobuf to the database as well
         self.db.ListingsStore().add_listing(data)
 
+        self._notify_listing_listeners(data)
+
+    def _notify_listing_listeners(self, metadata):
+        for listener in _listing_listeners:
+            try:
+                listener(self, metadata)
+            except Exception:
+                self.log.warning("Listing listener %s failed" % listener)
+
     def verify(self, sender_key):
         """
         Validate that an order sent over by a buyer is filled out correctly.
         """
 
         try:
-            contract_dict = json.loads(json.dumps(self.contract, indent=4), object_pairs_hook=OrderedDict)
-            del contract_dict["buyer_order"]
-            contract_hash = digest(json.dumps(contract_dict, indent=4))
+            contract_hash = self.digest_without("buyer_order")
 
             ref_hash = unhexlify(self.contract["buyer_order"]["order"]["ref_hash"])
 
@@ -985,10 +1106,7 @@ class Contract(object):
             else:
                 currency_code = price_json["fiat"]["currency_code"]
                 fiat_price = price_json["fiat"]["price"]
-                request = Request('https://api.bitcoinaverage.com/ticker/' + currency_code.upper() + '/last')
-                response = urlopen(request)
-                conversion_rate = response.read()
-                asking_price = float("{0:.8f}".format(float(fiat_price) / float(conversion_rate))) * quantity
+                asking_price = exchange_rates.to_btc(fiat_price, currency_code) * quantity
 
             if "shipping" in self.contract["vendor_offer"]["listing"]:
                 if not self.contract["vendor_offer"]["listing"]["shipping"]["free"]:
@@ -1003,15 +1121,7 @@ class Contract(object):
                                 "price"]["domestic"]
                             currency = self.contract["vendor_offer"]["listing"]["shipping"]["flat_fee"][
                                 "fiat"]["currency_code"]
-                            try:
-                                request = Request('https://api.bitcoinaverage.com/ticker/' +
-                                                  currency.upper() + '/last')
-                                response = urlopen(request)
-                                conversion_rate = response.read()
-                            except URLError:
-                                return False
-                            shipping_amount = float("{0:.8f}".format(float(price) /
-                                                                     float(conversion_rate))) * quantity
+                            shipping_amount = exchange_rates.to_btc(price, currency) * quantity
                     else:
                         if "bitcoin" in self.contract["vendor_offer"]["listing"]["shipping"]["flat_fee"]:
                             shipping_amount = float(self.contract["vendor_offer"]["listing"]["shipping"][
@@ -1021,15 +1131,7 @@ class Contract(object):
                                 "price"]["international"]
                             currency = self.contract["vendor_offer"]["listing"]["shipping"]["flat_fee"][
                                 "fiat"]["currency_code"]
-                            try:
-                                request = Request('https://api.bitcoinaverage.com/ticker/' +
-                                                  currency.upper() + '/last')
-                                response = urlopen(request)
-                                conversion_rate = response.read()
-                            except URLError:
-                                return False
-                            shipping_amount = float("{0:.8f}".format(float(price) /
-                                                                     float(conversion_rate))) * quantity
+                            shipping_amount = exchange_rates.to_btc(price, currency) * quantity
                     asking_price += shipping_amount
 
             if round(float(asking_price), 8) > float(self.contract["buyer_order"]["order"]["payment"]["amount"]):
@@ -1093,6 +1195,13 @@ class Contract(object):
         except Exception:
             return False
 
+    def verify_async(self, sender_key):
+        """
+        Same as `verify` but runs in the reactor's thread pool. Returns a `Deferred`
+        that fires with the result of `verify`.
+        """
+        return threads.deferToThread(self.verify, sender_key)
+
     def validate_for_moderation(self, proof_sig):
         validation_failures = []
 
@@ -1183,11 +1292,7 @@ class Contract(object):
 
         # validate vendor_order_confirmation
         if "vendor_order_confirmation" in self.contract:
-            contract_dict = json.loads(json.dumps(self.contract, indent=4), object_pairs_hook=OrderedDict)
-            del contract_dict["vendor_order_confirmation"]
-            if "buyer_receipt" in contract_dict:
-                del contract_dict["buyer_receipt"]
-            contract_hash = digest(json.dumps(contract_dict, indent=4)).encode("hex")
+            contract_hash = self.digest_without("vendor_order_confirmation", "buyer_receipt").encode("hex")
             ref_hash = self.contract["vendor_order_confirmation"]["invoice"]["ref_hash"]
             if ref_hash != contract_hash:
                 validation_failures.append("Reference hash in vendor_order_confirmation does not match order ID;")
@@ -1210,49 +1315,140 @@ class Contract(object):
         return validation_failures
 
     def __repr__(self):
-        return json.dumps(self.contract, indent=4)
+        return self.serialize()
+
+
+def sign_listing(listing, signing_key, bitcoin_privkey):
+    """
+    Returns the `vendor_offer` signatures over a serialized listing. It takes raw keys
+    rather than a `KeyChain` so it can be run in a worker process.
+    Args:
+        listing: the json serialized `listing` section of the contract.
+        signing_key: the seed of our guid signing key.
+        bitcoin_privkey: our bitcoin master private key.
+    """
+    signatures = {}
+    signatures["guid"] = base64.b64encode(nacl.signing.SigningKey(signing_key).sign(listing)[:64])
+    signatures["bitcoin"] = bitcoin.encode_sig(*bitcoin.ecdsa_raw_sign(listing, bitcoin_privkey))
+    return signatures
+
+
+ORDER_STATES = ("unfunded", "in progress", "trade receipts")
+
+
+def order_path(order_id, is_purchase, state):
+    """
+    Returns the path of the file holding an order in the given lifecycle state.
+    Args:
+        order_id: the hex encoded order id.
+        is_purchase: `True` for our purchases, `False` for our sales.
+        state: one of `ORDER_STATES`.
+    """
+    if is_purchase:
+        return DATA_FOLDER + "purchases/" + state + "/" + order_id + ".json"
+    else:
+        return DATA_FOLDER + "store/contracts/" + state + "/" + order_id + ".json"
+
+
+class OrderIndex(object):
+    """
+    Tracks where each of our purchases and sales lives on disk as it moves through
+    its lifecycle, so an order can be loaded with a single lookup rather than probing
+    every folder it might be in.
+
+    The order id to file path mapping is kept in its own file, not in the `HashMap`.
+    Anything in the `HashMap` can be fetched by other nodes with `rpc_get_contract`
+    and an order holds the buyer's shipping details. The mapping is loaded once and
+    shared by every `OrderIndex` using the same file.
+    """
+
+    _orders = {}
+
+    def __init__(self, database, file_path=DATA_FOLDER + "orders.json"):
+        self.db = database
+        self.file_path = file_path
+        if file_path not in OrderIndex._orders:
+            self._load()
+            OrderIndex._orders[file_path] = self.orders
+        self.orders = OrderIndex._orders[file_path]
+
+    def update(self, order_id, is_purchase, state):
+        """
+        Record that the order has moved to the given state and return its new file path.
+        """
+        file_path = order_path(order_id, is_purchase, state)
+        if self.orders.get(order_id) != file_path:
+            self.orders[order_id] = file_path
+            self._save()
+        return file_path
+
+    def get_file(self, order_id):
+        """
+        Returns the file path of the order or `None` if we don't have it.
+        """
+        file_path = self.orders.get(order_id)
+        if file_path is None:
+            # orders created before the index existed are found the slow way once and then recorded
+            for is_purchase in (True, False):
+                for state in ORDER_STATES:
+                    if os.path.exists(order_path(order_id, is_purchase, state)):
+                        return self.update(order_id, is_purchase, state)
+        return file_path
+
+    def get_state(self, order_id):
+        """
+        Returns a tuple of (is_purchase, state) for the order or `None` if we don't have it.
+        """
+        file_path = self.get_file(order_id)
+        if file_path is None:
+            return None
+        return file_path.startswith(DATA_FOLDER + "purchases/"), os.path.basename(os.path.dirname(file_path))
+
+    def _load(self):
+        # earlier versions kept the index in the HashMap, where it could be served to peers.
+        # Only paths in the order lifecycle folders are moved: our own listings are in
+        # store/contracts/listings/ and have to stay in the HashMap.
+        order_folders = tuple(os.path.dirname(order_path("", is_purchase, state)) + "/"
+                              for is_purchase in (True, False) for state in ORDER_STATES)
+        h = self.db.HashMap()
+        self.orders = {}
+        if os.path.isfile(self.file_path):
+            with open(self.file_path, 'r') as infile:
+                orders = json.load(infile)
+            for hash_value, file_path in orders.items():
+                if file_path.startswith(order_folders):
+                    self.orders[str(hash_value)] = str(file_path)
+                else:
+                    # put back listings a faulty migration moved out of the HashMap
+                    h.insert(str(hash_value), str(file_path))
+            if len(self.orders) < len(orders):
+                self._save()
+            return
+        for hash_value, file_path in h.get_all():
+            if file_path.startswith(order_folders):
+                self.orders[str(hash_value)] = str(file_path)
+                h.delete(hash_value)
+        self._save()
+
+    def _save(self):
+        tmp_path = self.file_path + ".tmp"
+        with open(tmp_path, 'w') as outfile:
+            json.dump(self.orders, outfile)
+        os.rename(tmp_path, self.file_path)
 
 
 def check_unfunded_for_payment(db, libbitcoin_client, notification_listener, testnet=False):
     """
     Run through the unfunded contracts in our database and query the
-    libbitcoin server to see if they received a payment.
+    libbitcoin server to see if they received a payment. Their payment
+    addresses are subscribed to again so later payments are picked up too.
+    See `market.funding.FundingRescan`.
+    Returns: a `Deferred` that fires with the rescan's stats when it's done.
     """
-    def check(order_ids, is_purchase=True):
-        for order_id in order_ids:
-            try:
-                if is_purchase:
-                    file_path = DATA_FOLDER + "purchases/unfunded/" + order_id[0] + ".json"
-                else:
-                    file_path = DATA_FOLDER + "store/contracts/unfunded/" + order_id[0] + ".json"
-                with open(file_path, 'r') as filename:
-                    order = json.load(filename, object_pairs_hook=OrderedDict)
-                c = Contract(db, contract=order, testnet=testnet)
-                c.blockchain = libbitcoin_client
-                c.notification_listener = notification_listener
-                c.is_purchase = is_purchase
-                addr = c.contract["buyer_order"]["order"]["payment"]["address"]
-
-                def history_fetched(ec, history):
-                    if not ec:
-                        # pylint: disable=W0612
-                        # pylint: disable=W0640
-                        for objid, txhash, index, height, value in history:
-                            def cb_txpool(ec, result):
-                                if ec:
-                                    libbitcoin_client.fetch_transaction(txhash, cb_chain)
-                                else:
-                                    c.on_tx_received(None, None, None, None, result)
-
-                            def cb_chain(ec, result):
-                                if not ec:
-                                    c.on_tx_received(None, None, None, None, result)
-
-                            libbitcoin_client.fetch_txpool_transaction(txhash, cb_txpool)
-
-                libbitcoin_client.fetch_history2(addr, history_fetched)
-            except Exception:
-                pass
+    # imported here since market.funding depends on this module
+    from market.funding import FundingRescan, get_watcher
     libbitcoin_client.refresh_connection()
-    check(db.Purchases().get_unfunded(), True)
-    check(db.Sales().get_unfunded(), False)
+    orders = [(order_id[0], True) for order_id in db.Purchases().get_unfunded()] + \
+             [(order_id[0], False) for order_id in db.Sales().get_unfunded()]
+    watcher = get_watcher(db, libbitcoin_client, notification_listener, testnet)
+    return FundingRescan(watcher).run(orders)
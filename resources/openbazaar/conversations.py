@@ -0,0 +1,59 @@
+from interfaces import MessageListener
+from protos.objects import PlaintextMessage
+from zope.interface import implementer
+
+
+@implementer(MessageListener)
+class ConversationSummary(object):
+    """
+    Keeps one summary per chat peer (last message, its timestamp and the number of
+    unread messages) so the conversation list doesn't have to be recomputed from
+    every stored message each time it's requested.
+
+    The summaries are loaded from the `MessageStore` the first time they're needed.
+    After that they're updated in place as chat messages arrive (this object is
+    registered as a `MessageListener` on the market protocol), are sent
+    (`add_message` with outgoing=True) and are marked as read (`mark_as_read`).
+    """
+
+    def __init__(self, database):
+        self.db = database
+        self.conversations = None
+
+    def notify(self, plaintext, signature):
+        if plaintext.type != PlaintextMessage.Type.Value("CHAT"):
+            return
+        self.add_message(plaintext.sender_guid.encode("hex"), plaintext.message, plaintext.timestamp,
+                         avatar_hash=plaintext.avatar_hash,
+                         public_key=plaintext.encryption_pubkey)
+
+    def add_message(self, guid, message, timestamp, avatar_hash=None, public_key=None, outgoing=False):
+        """
+        Updates the summary for a message. `guid` is the peer's hex encoded guid, as
+        the `MessageStore` keys conversations by; `avatar_hash` and `public_key` are raw.
+        """
+        if self.conversations is None:
+            # the store already has this message, so it'll be counted by the load
+            return
+        conversation = self.conversations.setdefault(guid, {"guid": guid, "unread": 0})
+        if timestamp >= conversation.get("timestamp", 0):
+            conversation["last_message"] = message
+            conversation["timestamp"] = timestamp
+        if avatar_hash:
+            conversation["avatar_hash"] = avatar_hash.encode("hex")
+        if public_key:
+            conversation["public_key"] = public_key.encode("hex")
+        if not outgoing:
+            conversation["unread"] = conversation.get("unread", 0) + 1
+
+    def mark_as_read(self, guid):
+        if self.conversations is not None and guid in self.conversations:
+            self.conversations[guid]["unread"] = 0
+
+    def get_conversations(self):
+        """
+        Returns the conversation summaries, most recently active first.
+        """
+        if self.conversations is None:
+            self.conversations = dict((c["guid"], dict(c)) for c in self.db.MessageStore().get_conversations())
+        return sorted(self.conversations.values(), key=lambda c: c.get("timestamp", 0), reverse=True)
@@ -0,0 +1,161 @@
+import json
+import time
+from collections import deque
+
+from interfaces import MessageListener
+from market.changes import change_log
+from protos.objects import PlaintextMessage
+from twisted.internet import reactor
+from zope.interface import implementer
+
+
+class EventFeed(object):
+    """
+    An in-memory, sequenced feed of the events clients would otherwise poll for
+    (new notifications and chat messages).
+
+    Each event gets a cursor made of the feed's start time and a sequence number.
+    The last `size` events are kept so a client that reconnects with the cursor of
+    the last event it saw can be sent what it missed. If those events are no longer
+    available, or the cursor is from before a restart, `get_events` returns `None`
+    and the client should re-fetch everything.
+    """
+
+    def __init__(self, size=1000):
+        self.epoch = str(int(time.time()))
+        self.sequence = 0
+        self.events = deque(maxlen=size)
+        self.subscribers = []
+
+    def publish(self, event_type, data):
+        self.sequence += 1
+        event = ("%s-%s" % (self.epoch, self.sequence), event_type, data)
+        self.events.append(event)
+        for subscriber in list(self.subscribers):
+            subscriber(event)
+
+    def get_events(self, cursor):
+        """
+        Returns the events after the given cursor or `None` if some of them have been
+        dropped.
+        """
+        try:
+            epoch, sequence = cursor.split("-")
+            sequence = int(sequence)
+        except ValueError:
+            return None
+        if epoch != self.epoch or sequence > self.sequence:
+            return None
+        oldest = self.sequence - len(self.events) + 1
+        if sequence < oldest - 1:
+            return None
+        return list(self.events)[sequence - oldest + 1:]
+
+    def subscribe(self, subscriber):
+        self.subscribers.append(subscriber)
+
+    def unsubscribe(self, subscriber):
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+
+
+event_feed = EventFeed()
+
+
+def notify(notification_listener, guid, handle, notif_type, order_id, title, image_hash):
+    """
+    Sends a notification through the notification listener, publishes it to the
+    event feed and records it in the change log. `guid` and `image_hash` are raw,
+    as the notification listener expects.
+    """
+    notification_listener.notify(guid, handle, notif_type, order_id, title, image_hash)
+    data = {
+        "guid": guid.encode("hex"),
+        "handle": handle,
+        "type": notif_type,
+        "order_id": order_id,
+        "title": title,
+        "image_hash": image_hash.encode("hex")
+    }
+    event_feed.publish("notification", data)
+    change_log.record("notification", "%s:%s" % (order_id, notif_type), data)
+
+
+@implementer(MessageListener)
+class MessagePublisher(object):
+    """
+    Publishes incoming chat messages to the event feed and records them in the
+    change log.
+    """
+
+    def __init__(self, feed=event_feed):
+        self.feed = feed
+
+    def notify(self, plaintext, signature):
+        if plaintext.type != PlaintextMessage.Type.Value("CHAT"):
+            return
+        data = {
+            "guid": plaintext.sender_guid.encode("hex"),
+            "handle": plaintext.handle,
+            "message": plaintext.message,
+            "timestamp": plaintext.timestamp,
+            "avatar_hash": plaintext.avatar_hash.encode("hex")
+        }
+        self.feed.publish("chat", data)
+        change_log.record("chat", data["guid"], data)
+
+
+class EventStream(object):
+    """
+    Streams the feed to an HTTP client as server-sent events.
+
+    Anything published after `cursor` is sent first, then new events as they're
+    published. Events that arrive within `delay` seconds of each other are written
+    together, so a burst (for example a block confirming many orders) goes out as a
+    single write. A comment is sent every `keepalive` seconds to stop proxies from
+    closing an idle connection.
+    """
+
+    def __init__(self, request, feed=event_feed, cursor=None, delay=0.25, keepalive=30):
+        self.request = request
+        self.feed = feed
+        self.delay = delay
+        self.keepalive = keepalive
+        self.pending = []
+        self._flush_call = None
+        self._keepalive_call = None
+
+        request.setHeader("content-type", "text/event-stream")
+        request.setHeader("cache-control", "no-cache")
+        if cursor is not None:
+            missed = feed.get_events(cursor)
+            if missed is None:
+                # tell the client to re-fetch and resume from here
+                self.pending.append(("%s-%s" % (feed.epoch, feed.sequence), "reset", {}))
+            else:
+                self.pending.extend(missed)
+        feed.subscribe(self.on_event)
+        request.notifyFinish().addBoth(self.close)
+        self.flush()
+
+    def on_event(self, event):
+        self.pending.append(event)
+        if self._flush_call is None or not self._flush_call.active():
+            self._flush_call = reactor.callLater(self.delay, self.flush)
+
+    def flush(self):
+        for call in (self._flush_call, self._keepalive_call):
+            if call is not None and call.active():
+                call.cancel()
+        frames = []
+        for cursor, event_type, data in self.pending:
+            frames.append("id: %s\nevent: %s\ndata: %s\n\n" % (cursor, event_type, json.dumps(data)))
+        self.pending = []
+        self.request.write("".join(frames) if frames else ": keepalive\n\n")
+        self._keepalive_call = reactor.callLater(self.keepalive, self.flush)
+
+    def close(self, result=None):
+        self.feed.unsubscribe(self.on_event)
+        for call in (self._flush_call, self._keepalive_call):
+            if call is not None and call.active():
+                call.cancel()
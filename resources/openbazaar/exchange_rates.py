@@ -0,0 +1,132 @@
+import json
+import threading
+import time
+from urllib2 import Request, urlopen
+
+from log import Logger
+
+
+class RateUnavailable(Exception):
+    pass
+
+
+class BitcoinAverageProvider(object):
+    """
+    Fetches the last BTC price in a given currency from the bitcoinaverage.com ticker.
+    """
+
+    URL = "https://api.bitcoinaverage.com/ticker/%s/last"
+
+    def __init__(self, timeout=10):
+        self.timeout = timeout
+
+    def get_rate(self, currency_code):
+        response = urlopen(Request(self.URL % currency_code), timeout=self.timeout)
+        return float(response.read())
+
+
+class FileProvider(object):
+    """
+    Reads BTC prices from a json file mapping currency codes to rates, e.g.
+    {"USD": 415.25, "EUR": 382.1}. Useful for tests and running offline.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+
+    def get_rate(self, currency_code):
+        with open(self.file_path, 'r') as filename:
+            rates = json.load(filename)
+        return float(rates[currency_code])
+
+
+class ExchangeRates(object):
+    """
+    A per-currency cache in front of a rate provider.
+
+    Rates are served from memory for `ttl` seconds. When a rate expires only one
+    thread fetches it from the provider; any other lookups for the same currency
+    wait for that result rather than making their own request. If the provider
+    fails we fall back to the last rate we have as long as it is less than
+    `max_stale` seconds old, otherwise `RateUnavailable` is raised. After a failure
+    the provider isn't asked for that currency again for `retry_after` seconds.
+    """
+
+    def __init__(self, provider, ttl=300, max_stale=3600, retry_after=60):
+        """
+        Args:
+            provider: any object with a `get_rate(currency_code)` method that returns
+                the price of one bitcoin in that currency.
+            ttl: seconds a fetched rate is considered fresh.
+            max_stale: seconds an expired rate may still be used if the provider fails.
+            retry_after: seconds to wait after the provider fails before asking it again.
+        """
+        self.provider = provider
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.retry_after = retry_after
+        self.log = Logger(system=self)
+        self._rates = {}
+        self._failures = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def set_provider(self, provider):
+        """
+        Swap in a different provider and drop anything fetched from the old one.
+        """
+        with self._lock:
+            self.provider = provider
+            self._rates = {}
+            self._failures = {}
+
+    def get_rate(self, currency_code):
+        currency_code = currency_code.upper()
+        rate = self._get_fresh(currency_code)
+        if rate is not None:
+            return rate
+        with self._lock:
+            currency_lock = self._locks.setdefault(currency_code, threading.Lock())
+        with currency_lock:
+            # another thread may have fetched it while we were waiting on the lock
+            rate = self._get_fresh(currency_code)
+            if rate is not None:
+                return rate
+            failure = self._failures.get(currency_code)
+            if failure is not None and time.time() - failure[0] < self.retry_after:
+                return self._get_stale(currency_code, failure[1])
+            try:
+                rate = float(self.provider.get_rate(currency_code))
+                if rate <= 0:
+                    raise ValueError("invalid rate %s" % rate)
+            except Exception, e:
+                self._failures[currency_code] = (time.time(), e)
+                self.log.warning("Failed to fetch the %s exchange rate, not retrying for %s seconds: %s" %
+                                 (currency_code, self.retry_after, e))
+                return self._get_stale(currency_code, e)
+            self._failures.pop(currency_code, None)
+            self._rates[currency_code] = (rate, time.time())
+            return rate
+
+    def to_btc(self, price, currency_code):
+        """
+        Converts a price in the given currency to bitcoin, rounded to 8 decimal places.
+        """
+        return float("{0:.8f}".format(float(price) / self.get_rate(currency_code)))
+
+    def _get_stale(self, currency_code, error):
+        if currency_code in self._rates:
+            rate, timestamp = self._rates[currency_code]
+            if time.time() - timestamp < self.max_stale:
+                return rate
+        raise RateUnavailable("No %s exchange rate available: %s" % (currency_code, error))
+
+    def _get_fresh(self, currency_code):
+        if currency_code in self._rates:
+            rate, timestamp = self._rates[currency_code]
+            if time.time() - timestamp < self.ttl:
+                return rate
+        return None
+
+
+exchange_rates = ExchangeRates(BitcoinAverageProvider())
@@ -0,0 +1,241 @@
+import json
+import os
+from collections import OrderedDict
+
+import bitcoin
+from constants import DATA_FOLDER
+from log import Logger
+from market.contracts import Contract, OrderIndex
+from market.utils import deserialize
+from twisted.internet import defer, reactor
+
+_watchers = {}
+
+
+def get_watcher(database, libbitcoin_client, notification_listener, testnet=False):
+    """
+    Returns the `FundingWatcher` for the libbitcoin client, creating it if needed.
+    """
+    if libbitcoin_client not in _watchers:
+        _watchers[libbitcoin_client] = FundingWatcher(database, libbitcoin_client, notification_listener, testnet)
+    return _watchers[libbitcoin_client]
+
+
+class FundingWatcher(object):
+    """
+    Watches the payment addresses of all our unfunded orders.
+
+    Rather than each order keeping its `Contract` in memory with its own subscription
+    callback, every address is subscribed with the same callback and the watcher only
+    keeps a small index of output script -> address -> (order id, is purchase). When
+    a transaction pays one of the scripts the order's contract is loaded from disk,
+    handed the transaction and dropped again; the contract saves how much it's been
+    paid with the order, and calls `unwatch` once it's fully funded. Orders whose
+    contract can no longer be found are removed from the index.
+
+    The index is saved to `file_path` (at most once a second) so the addresses can be
+    rescanned after a restart without opening every contract.
+    """
+
+    def __init__(self, database, libbitcoin_client, notification_listener, testnet=False,
+                 file_path=DATA_FOLDER + "funding_addresses.json"):
+        self.db = database
+        self.blockchain = libbitcoin_client
+        self.notification_listener = notification_listener
+        self.testnet = testnet
+        self.file_path = file_path
+        self.log = Logger(system=self)
+        self.addresses = {}
+        self.orders = {}
+        self.scripts = {}
+        self.subscribed = set()
+        self._save_call = None
+        self._load()
+
+    def get_address(self, order_id):
+        """
+        Returns the payment address of an order being watched or `None`.
+        """
+        return self.orders.get(order_id)
+
+    def watch(self, address, order_id, is_purchase):
+        """
+        Subscribe to payments to the address of an unfunded order. Watching an address
+        that's already subscribed does nothing.
+        """
+        address = str(address)
+        if self.addresses.get(address) != (order_id, is_purchase):
+            self._add(address, order_id, is_purchase)
+            self._schedule_save()
+        # the index is loaded from disk at startup but nothing is subscribed until this is called
+        if address not in self.subscribed:
+            self.subscribed.add(address)
+            self.blockchain.subscribe_address(address, notification_cb=self.on_tx_received)
+
+    def unwatch(self, address):
+        """
+        Stop watching the address, once its order is funded.
+        """
+        address = str(address)
+        if address in self.addresses:
+            order_id, is_purchase = self.addresses.pop(address)
+            self.orders.pop(order_id, None)
+            self.scripts.pop(bitcoin.address_to_script(address), None)
+            self._schedule_save()
+        if address in self.subscribed:
+            self.subscribed.discard(address)
+            self.blockchain.unsubscribe_address(address, self.on_tx_received)
+
+    def on_tx_received(self, address_version, address_hash, height, block_hash, tx):
+        try:
+            transaction = deserialize(tx.encode("hex"))
+            matched = set()
+            for output in transaction["outs"]:
+                address = self.scripts.get(output["script"])
+                if address is not None and address not in matched:
+                    matched.add(address)
+                    contract = self._load_contract(*self.addresses[address])
+                    if contract is None:
+                        self.unwatch(address)
+                    else:
+                        contract.on_tx_received(address_version, address_hash, height, block_hash, tx)
+        except Exception, e:
+            self.log.critical("Error processing bitcoin transaction: %s" % e)
+
+    def _load_contract(self, order_id, is_purchase):
+        file_path = OrderIndex(self.db).get_file(order_id)
+        if file_path is None:
+            self.log.warning("No contract found for unfunded order %s, no longer watching it" % order_id)
+            return None
+        with open(file_path, 'r') as filename:
+            contract = Contract(self.db, contract=json.load(filename, object_pairs_hook=OrderedDict),
+                                testnet=self.testnet)
+        contract.blockchain = self.blockchain
+        contract.notification_listener = self.notification_listener
+        contract.is_purchase = is_purchase
+        contract.funding_watcher = self
+        return contract
+
+    def _add(self, address, order_id, is_purchase):
+        self.addresses[address] = (order_id, is_purchase)
+        self.orders[order_id] = address
+        self.scripts[bitcoin.address_to_script(address)] = address
+
+    def _load(self):
+        if os.path.isfile(self.file_path):
+            with open(self.file_path, 'r') as infile:
+                for address, (order_id, is_purchase) in json.load(infile).items():
+                    self._add(str(address), str(order_id), is_purchase)
+
+    def _schedule_save(self):
+        if self._save_call is None or not self._save_call.active():
+            self._save_call = reactor.callLater(1, self._save)
+
+    def _save(self):
+        tmp_path = self.file_path + ".tmp"
+        with open(tmp_path, 'w') as outfile:
+            json.dump(self.addresses, outfile)
+        os.rename(tmp_path, self.file_path)
+
+
+class FundingRescan(object):
+    """
+    Checks the payment addresses of unfunded orders for payments made while we weren't
+    watching them (for example while the node was down) and subscribes to them again.
+
+    Addresses come from the `FundingWatcher` index, so contracts are only opened for
+    orders made before the index existed or when a payment is found. Orders are
+    scanned `batch_size` at a time with at most `max_in_flight` queries to the
+    libbitcoin server outstanding. Progress is logged after each batch and the
+    counts are kept in `stats`.
+    """
+
+    def __init__(self, watcher, max_in_flight=8, batch_size=100):
+        self.watcher = watcher
+        self.blockchain = watcher.blockchain
+        self.batch_size = batch_size
+        self.log = Logger(system=self)
+        self.stats = {"orders": 0, "scanned": 0, "missing": 0, "transactions": 0, "errors": 0}
+        self._semaphore = defer.DeferredSemaphore(max_in_flight)
+
+    def run(self, orders):
+        """
+        Rescan a list of (order id, is purchase) tuples. Returns a `Deferred` that fires
+        with `stats` once every order has been scanned.
+        """
+        self.stats["orders"] = len(orders)
+        d = defer.succeed(None)
+        for i in range(0, len(orders), self.batch_size):
+            d.addCallback(lambda _, batch=orders[i:i + self.batch_size]: self._scan_batch(batch))
+        return d.addCallback(lambda _: self.stats)
+
+    def _scan_batch(self, batch):
+        ds = [self._scan(order_id, is_purchase) for order_id, is_purchase in batch]
+        return defer.DeferredList(ds).addCallback(self._log_progress)
+
+    def _scan(self, order_id, is_purchase):
+        def history_fetched(history):
+            # pylint: disable=W0612
+            txhashes = set(txhash for objid, txhash, index, height, value in history)
+            return defer.DeferredList([self._fetch_transaction(txhash).addCallbacks(tx_fetched, failed)
+                                       for txhash in txhashes])
+
+        def tx_fetched(tx):
+            self.stats["transactions"] += 1
+            self.watcher.on_tx_received(None, None, None, None, tx)
+
+        def failed(failure):
+            self.stats["errors"] += 1
+            self.log.warning("Failed to rescan order %s: %s" % (order_id, failure.getErrorMessage()))
+
+        def scanned(result):
+            self.stats["scanned"] += 1
+
+        try:
+            address = self.watcher.get_address(order_id)
+            if OrderIndex(self.watcher.db).get_file(order_id) is None:
+                # the order was deleted, stop watching it
+                self.stats["missing"] += 1
+                if address is not None:
+                    self.watcher.unwatch(address)
+                return defer.succeed(None).addCallback(scanned)
+            if address is None:
+                address = self._read_address(order_id)
+            self.watcher.watch(address, order_id, is_purchase)
+        except Exception:
+            return defer.fail().addErrback(failed).addCallback(scanned)
+        return self._query(self.blockchain.fetch_history2, address)\
+            .addCallback(history_fetched).addErrback(failed).addCallback(scanned)
+
+    def _fetch_transaction(self, txhash):
+        # look in the memory pool first and fall back to the chain
+        return self._query(self.blockchain.fetch_txpool_transaction, txhash)\
+            .addErrback(lambda failure: self._query(self.blockchain.fetch_transaction, txhash))
+
+    def _query(self, method, *args):
+        """
+        Calls a callback based libbitcoin client method with a slot from the semaphore
+        and returns a `Deferred` for its result.
+        """
+        def call():
+            d = defer.Deferred()
+
+            def cb(ec, result):
+                if ec:
+                    d.errback(Exception("libbitcoin error: %s" % ec))
+                else:
+                    d.callback(result)
+            method(*(args + (cb,)))
+            return d
+        return self._semaphore.run(call)
+
+    def _read_address(self, order_id):
+        # orders from before the funding index existed
+        file_path = OrderIndex(self.watcher.db).get_file(order_id)
+        with open(file_path, 'r') as filename:
+            contract = json.load(filename, object_pairs_hook=OrderedDict)
+        return contract["buyer_order"]["order"]["payment"]["address"]
+
+    def _log_progress(self, results):
+        self.log.info("Rescanned %(scanned)s of %(orders)s unfunded orders, %(missing)s missing, "
+                      "%(transactions)s transactions fetched, %(errors)s errors" % self.stats)
@@ -0,0 +1,136 @@
+import random
+
+from dht.utils import digest
+from log import Logger
+from market.contracts import load_listings
+from twisted.internet import defer, reactor, threads
+
+
+class KeywordPublisher(object):
+    """
+    Publishes the keyword -> contract records for our listings to the DHT.
+
+    Calls to `publish` and `unpublish` are queued and sent together after `delay`
+    seconds, so a bulk update of many listings turns into a single batch. Records
+    that are already published or queued are dropped rather than stored again. The
+    node proto sent with each record is serialized once per batch, and each contract
+    id is signed at most once per batch no matter how many of its keywords are being
+    deleted. At most `max_concurrent` store/delete RPCs are in flight at once.
+
+    Everything that's published is stored again every `republish_interval` seconds,
+    plus or minus `jitter` of that interval so nodes don't all republish at once.
+    Call `load` at startup so listings from before the restart are republished too.
+    """
+
+    def __init__(self, kserver, keychain, delay=1, max_concurrent=8, republish_interval=3600, jitter=0.1):
+        self.kserver = kserver
+        self.keychain = keychain
+        self.delay = delay
+        self.republish_interval = republish_interval
+        self.jitter = jitter
+        self.log = Logger(system=self)
+        self.records = {}
+        self._to_set = {}
+        self._to_delete = {}
+        self._semaphore = defer.DeferredSemaphore(max_concurrent)
+        self._flush_call = None
+        self._republish_call = None
+        self._unpublished = None
+
+    def load(self, database):
+        """
+        Adds the keywords of every listing we already have to the records that are
+        republished. The contracts are read on a worker thread.
+        Returns a `Deferred` that fires once they're added.
+        """
+        def seed(listings):
+            for metadata, keywords in listings:
+                # skip listings deleted while they were being read
+                if metadata.contract_hash not in self._unpublished:
+                    for keyword in set(k.lower() for k in keywords):
+                        self.records.setdefault(keyword, set()).add(metadata.contract_hash)
+            self._unpublished = None
+            self._schedule_republish()
+
+        def failed(failure):
+            self._unpublished = None
+            self.log.warning("Failed to load listing keywords: %s" % failure.getErrorMessage())
+        self._unpublished = set()
+        return threads.deferToThread(load_listings, database).addCallbacks(seed, failed)
+
+    def publish(self, keywords, contract_id):
+        """
+        Queue records mapping each keyword to the contract id.
+        """
+        for keyword in set(k.lower() for k in keywords):
+            self._discard(self._to_delete, keyword, contract_id)
+            if contract_id not in self.records.get(keyword, ()):
+                self.records.setdefault(keyword, set()).add(contract_id)
+                self._to_set.setdefault(keyword, set()).add(contract_id)
+        self._schedule_flush()
+
+    def unpublish(self, keywords, contract_id):
+        """
+        Queue the removal of the records mapping each keyword to the contract id.
+        """
+        if self._unpublished is not None:
+            self._unpublished.add(contract_id)
+        for keyword in set(k.lower() for k in keywords):
+            self._discard(self.records, keyword, contract_id)
+            self._discard(self._to_set, keyword, contract_id)
+            self._to_delete.setdefault(keyword, set()).add(contract_id)
+        self._schedule_flush()
+
+    def flush(self):
+        """
+        Send everything that's queued now. Returns a `Deferred` that fires once all
+        the RPCs have completed.
+        """
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        to_set, self._to_set = self._to_set, {}
+        to_delete, self._to_delete = self._to_delete, {}
+
+        ds = []
+        signatures = {}
+        for keyword, contract_ids in to_delete.items():
+            for contract_id in contract_ids:
+                if contract_id not in signatures:
+                    signatures[contract_id] = self.keychain.signing_key.sign(contract_id)[:64]
+                ds.append(self._semaphore.run(self.kserver.delete, keyword, contract_id, signatures[contract_id]))
+        if to_set:
+            value = self.kserver.node.getProto().SerializeToString()
+            for keyword, contract_ids in to_set.items():
+                for contract_id in contract_ids:
+                    ds.append(self._semaphore.run(self.kserver.set, digest(keyword), contract_id, value))
+
+        self._schedule_republish()
+        return defer.DeferredList(ds, consumeErrors=True).addCallback(self._log_failures)
+
+    def republish(self):
+        for keyword, contract_ids in self.records.items():
+            self._to_set.setdefault(keyword, set()).update(contract_ids)
+        self._republish_call = None
+        return self.flush()
+
+    def _schedule_flush(self):
+        if self._flush_call is None or not self._flush_call.active():
+            self._flush_call = reactor.callLater(self.delay, self.flush)
+
+    def _schedule_republish(self):
+        if self.records and (self._republish_call is None or not self._republish_call.active()):
+            interval = self.republish_interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+            self._republish_call = reactor.callLater(interval, self.republish)
+
+    def _log_failures(self, results):
+        failures = [result for success, result in results if not success]
+        if failures:
+            self.log.warning("%s of %s keyword updates failed (stores are retried on the next republish): %s" %
+                             (len(failures), len(results), failures[0].getErrorMessage()))
+
+    @staticmethod
+    def _discard(records, keyword, contract_id):
+        if keyword in records:
+            records[keyword].discard(contract_id)
+            if not records[keyword]:
+                del records[keyword]
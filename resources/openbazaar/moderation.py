@@ -1,13 +1,14 @@
 import json
 import nacl.signing
-import os
 import time
 from binascii import unhexlify
 from collections import OrderedDict
 from constants import DATA_FOLDER
 from dht.utils import digest
 from keyutils.keys import KeyChain
-from market.contracts import Contract
+from market import events
+from market.changes import change_log
+from market.contracts import Contract, OrderIndex
 from protos.objects import PlaintextMessage
 
 
@@ -75,9 +76,11 @@ def process_dispute(contract, db, message_listener, notification_listener, testn
 
     if db.Purchases().get_purchase(order_id) is not None:
         db.Purchases().update_status(order_id, 4)
+        change_log.record("purchase", order_id, {"status": 4})
 
     elif db.Sales().get_sale(order_id) is not None:
-        db.Purchases().update_status(order_id, 4)
+        db.Sales().update_status(order_id, 4)
+        change_log.record("sale", order_id, {"status": 4})
 
     elif "moderators" in contract["vendor_offer"]["listing"]:
         # TODO: make sure a case isn't already open in the db
@@ -110,6 +113,7 @@ def process_dispute(contract, db, message_listener, notification_listener, testn
                                 contract["vendor_offer"]["listing"]["item"]["image_hashes"][0],
                                 buyer, vendor, json.dumps(validation_failures),
                                 contract["dispute"]["info"]["claim"])
+            change_log.record("case", order_id, {"status": "open"})
 
             with open(DATA_FOLDER + "cases/" + order_id + ".json", 'wb') as outfile:
                 outfile.write(json.dumps(contract, indent=4))
@@ -117,9 +121,9 @@ def process_dispute(contract, db, message_listener, notification_listener, testn
         raise Exception("Order ID for dispute not found")
 
     message_listener.notify(p, "")
-    notification_listener.notify(guid, handle, "dispute_open", order_id,
-                                 contract["vendor_offer"]["listing"]["item"]["title"],
-                                 contract["vendor_offer"]["listing"]["item"]["image_hashes"][0])
+    events.notify(notification_listener, guid, handle, "dispute_open", order_id,
+                  contract["vendor_offer"]["listing"]["item"]["title"],
+                  unhexlify(contract["vendor_offer"]["listing"]["item"]["image_hashes"][0]))
 
 
 def close_dispute(resolution_json, db, message_listener, notification_listener, testnet):
@@ -137,10 +141,7 @@ def close_dispute(resolution_json, db, message_listener, notification_listener,
 
     order_id = resolution_json["dispute_resolution"]["resolution"]["order_id"]
 
-    if os.path.exists(DATA_FOLDER + "purchases/in progress/" + order_id + ".json"):
-        file_path = DATA_FOLDER + "purchases/trade receipts/" + order_id + ".json"
-    elif os.path.exists(DATA_FOLDER + "store/contracts/in progress/" + order_id + ".json"):
-        file_path = DATA_FOLDER + "store/contracts/in progress/" + order_id + ".json"
+    file_path = OrderIndex(db).get_file(order_id)
 
     with open(file_path, 'r') as filename:
         contract = json.load(filename, object_pairs_hook=OrderedDict)
@@ -161,6 +162,7 @@ def close_dispute(resolution_json, db, message_listener, notification_listener,
 
     with open(file_path, 'wb') as outfile:
         outfile.write(json.dumps(contract, indent=4))
+    change_log.record("case", order_id, {"status": "closed"})
 
     p = PlaintextMessage()
     p.sender_guid = moderator_guid
@@ -174,6 +176,6 @@ def close_dispute(resolution_json, db, message_listener, notification_listener,
     p.avatar_hash = moderator_avatar
 
     message_listener.notify(p, "")
-    notification_listener.notify(moderator_guid, moderator_handle, "dispute_close", order_id,
-                                 contract["vendor_offer"]["listing"]["item"]["title"],
-                                 contract["vendor_offer"]["listing"]["item"]["image_hashes"][0])
\ No newline at end of file
+    events.notify(notification_listener, moderator_guid, moderator_handle, "dispute_close", order_id,
+                  contract["vendor_offer"]["listing"]["item"]["title"],
+                  unhexlify(contract["vendor_offer"]["listing"]["item"]["image_hashes"][0]))
\ No newline at end of file
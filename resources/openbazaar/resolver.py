@@ -0,0 +1,62 @@
+import time
+
+from market.cache import LRUCache, RequestCoalescer
+from twisted.internet import defer
+
+
+class NodeResolver(object):
+    """
+    A cache in front of `kserver.resolve` so looking up the same guid over and over
+    (as every handler for a remote node does) doesn't cost a DHT lookup each time.
+
+    Resolved nodes are kept for `ttl` seconds and guids that couldn't be resolved for
+    `negative_ttl` seconds. A lookup for a node that's more than `refresh_ahead` of
+    the way through its ttl returns the cached node straight away and refreshes it in
+    the background. Concurrent lookups for the same guid share one DHT lookup. A node
+    that stops answering RPCs is dropped from the cache (see `check_response`) so the
+    next lookup finds it again.
+    """
+
+    def __init__(self, kserver, ttl=600, negative_ttl=60, refresh_ahead=0.75, max_entries=10000):
+        self.kserver = kserver
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.refresh_ahead = refresh_ahead
+        self.nodes = LRUCache(max_entries, sizeof=lambda entry: 1)
+        self.lookups = RequestCoalescer()
+
+    def resolve(self, guid):
+        """
+        Returns a `Deferred` that fires with the `Node` for the (raw) guid, or `None`
+        if it can't be found.
+        """
+        entry = self.nodes.get(guid)
+        if entry is not None:
+            node, timestamp = entry
+            age = time.time() - timestamp
+            if node is None and age < self.negative_ttl:
+                return defer.succeed(None)
+            elif node is not None and age < self.ttl:
+                if age > self.ttl * self.refresh_ahead:
+                    self._lookup(guid).addErrback(lambda failure: None)
+                return defer.succeed(node)
+        return self._lookup(guid)
+
+    def invalidate(self, guid):
+        self.nodes.pop(guid)
+
+    def check_response(self, result, node):
+        """
+        A callback for the result of an RPC to a resolved node. The market RPCs return
+        `None` when the node doesn't respond, in which case the node is dropped from
+        the cache since it's likely moved or gone offline. The result is passed on.
+        """
+        if result is None:
+            self.invalidate(node.id)
+        return result
+
+    def _lookup(self, guid):
+        def store(node):
+            self.nodes.put(guid, (node, time.time()))
+            return node
+        return self.lookups.run(guid, lambda: self.kserver.resolve(guid).addCallback(store))
@@ -1,28 +1,62 @@
 __author__ = 'chris'
+import bitcoin
+import hashlib
 import json
 import os
+import tempfile
+import zlib
 from binascii import unhexlify
 from collections import OrderedDict
+from multiprocessing import Pool, TimeoutError
 
 from txrestapi.resource import APIResource
 from txrestapi.methods import GET, POST, DELETE
 from twisted.web import server
 from twisted.web.resource import NoResource
 from twisted.web import http
-from twisted.internet import defer, reactor
+from twisted.internet import reactor, threads
 from twisted.protocols.basic import FileSender
 
 from constants import DATA_FOLDER
 from protos.countries import CountryCode
 from protos import objects
 from keyutils.keys import KeyChain
+from log import Logger
 from dht.utils import digest
 from market.profile import Profile
-from market.contracts import Contract
+from market.resolver import NodeResolver
+from market.cache import DiskCache, LRUCache, RequestCoalescer, StaleWhileRevalidateCache
+from market.changes import change_log
+from market.contracts import Contract, OrderIndex, add_listing_listener, sign_listing
+from market.conversations import ConversationSummary
+from market.events import EventStream, MessagePublisher
+from market.keywords import KeywordPublisher
+from market.search import ListingIndex
+from market.thumbnails import make_thumbnails, thumbnail_key
 from net.upnp import PortMapper
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 DEFAULT_RECORDS_COUNT = 20
 DEFAULT_RECORDS_OFFSET = 0
+GZIP_MIN_SIZE = 1024
+MAX_CACHED_IMAGE_SIZE = 256 * 1024
+IMAGE_CACHE_SIZE = 32 * 1024 * 1024
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+THUMBNAIL_FALLBACK_CACHE_CONTROL = "public, max-age=60"
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+UPLOAD_PREFIX = "upload-"
+PROCESS_TIMEOUT = 60
+REMOTE_CACHE_SIZE = 512 * 1024 * 1024
+
+# Response formats by content type, in order of preference. The first is the default
+# for clients that don't ask for one of the others in their Accept header.
+ENCODERS = OrderedDict([("application/json", lambda obj: json.dumps(obj, separators=(",", ":")))])
+if msgpack is not None:
+    ENCODERS["application/x-msgpack"] = msgpack.packb
 
 
 def str_to_bool(s):
@@ -34,6 +68,343 @@ def str_to_bool(s):
         raise ValueError
 
 
+def is_paged(request):
+    return "offset" in request.args or "limit" in request.args or "cursor" in request.args
+
+
+def get_page(request, records, key):
+    """
+    Returns the slice of `records` selected by the request's `offset` and `limit`, or
+    `cursor` and `limit`, arguments along with the cursor for the next page (`None` on
+    the last page). A cursor is the hex encoded key of the last record on the previous
+    page, so paging stays consistent when records are added in between requests.
+    All records are returned if the request isn't paged.
+    """
+    if not is_paged(request):
+        return records, None
+    limit = int(request.args["limit"][0]) if "limit" in request.args else DEFAULT_RECORDS_COUNT
+    if "cursor" in request.args:
+        cursor = unhexlify(request.args["cursor"][0])
+        start = len(records)
+        for i, record in enumerate(records):
+            if key(record) == cursor:
+                start = i + 1
+                break
+    else:
+        start = int(request.args["offset"][0]) if "offset" in request.args else DEFAULT_RECORDS_OFFSET
+    page = records[start:start + limit]
+    next_cursor = key(page[-1]).encode("hex") if page and start + limit < len(records) else None
+    return page, next_cursor
+
+
+def listing_to_json(l):
+    """
+    Converts a `ListingMetadata` protobuf into the dict the API returns for a listing.
+    """
+    listing_json = {
+        "title": l.title,
+        "contract_hash": l.contract_hash.encode("hex"),
+        "thumbnail_hash": l.thumbnail_hash.encode("hex"),
+        "category": l.category,
+        "price": l.price,
+        "currency_code": l.currency_code,
+        "nsfw": l.nsfw,
+        "origin": str(CountryCode.Name(l.origin)),
+        "ships_to": []
+    }
+    for country in l.ships_to:
+        listing_json["ships_to"].append(str(CountryCode.Name(country)))
+    return listing_json
+
+
+def listings_to_json(listings):
+    """
+    Converts a `Listings` protobuf into the dict returned by /api/v1/get_listings.
+    """
+    return {"listings": [listing_to_json(l) for l in listings.listing]}
+
+
+def encode_utf8(obj):
+    """
+    Recursively converts the unicode strings returned by `json.loads` to utf-8 encoded
+    `str` so json input is handled the same way as form arguments.
+    """
+    if isinstance(obj, unicode):
+        return obj.encode("utf-8")
+    elif isinstance(obj, list):
+        return [encode_utf8(i) for i in obj]
+    elif isinstance(obj, dict):
+        return OrderedDict((encode_utf8(k), encode_utf8(v)) for k, v in obj.items())
+    return obj
+
+
+def add_encoder(content_type, encode):
+    """
+    Register a function that serializes response objects to `content_type`.
+    """
+    ENCODERS[content_type] = encode
+
+
+def negotiate(header, offered):
+    """
+    Picks the value in `offered` (content types or codings) the client prefers
+    according to an Accept or Accept-Encoding `header`, by q-value and then by the
+    order of `offered`. `type/*` and `*` ranges are matched as well. Returns `None`
+    if none of them is acceptable.
+    """
+    quality = {}
+    for part in header.split(","):
+        params = part.strip().split(";")
+        value = params[0].strip().lower()
+        q = 1.0
+        for param in params[1:]:
+            name, _, number = param.strip().partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(number)
+                except ValueError:
+                    q = 0.0
+        if value:
+            quality[value] = q
+    best = None
+    best_q = 0.0
+    for value in offered:
+        q = quality.get(value, quality.get(value.split("/")[0] + "/*", quality.get("*/*", quality.get("*", 0.0))))
+        if q > best_q:
+            best, best_q = value, q
+    return best
+
+
+def write_response(request, obj, cache=None):
+    """
+    Serializes `obj` in the format the client asked for in its Accept header (compact
+    json by default, indented if the request has `pretty=true`), gzips it if the
+    client accepts it and it's large enough to be worth it, and writes it to the
+    request with the matching content type.
+    Args:
+        request: the request to write the response to.
+        obj: the response object.
+        cache: an optional dict the encoded response is kept in for each format so
+            the same object doesn't have to be encoded again.
+    """
+    accept = request.getHeader("accept")
+    content_type = (accept and negotiate(accept, ENCODERS)) or ENCODERS.keys()[0]
+    pretty = "pretty" in request.args and str_to_bool(request.args["pretty"][0])
+    gzip = negotiate(request.getHeader("accept-encoding") or "", ["gzip"]) is not None
+    key = (content_type, pretty, gzip)
+    if cache is not None and key in cache:
+        body, compressed = cache[key]
+    else:
+        body = json.dumps(obj, indent=4) if pretty and content_type == "application/json" else \
+            ENCODERS[content_type](obj)
+        compressed = gzip and len(body) >= GZIP_MIN_SIZE
+        if compressed:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+        if cache is not None:
+            cache[key] = (body, compressed)
+    request.setHeader("content-type", content_type)
+    request.setHeader("vary", "Accept, Accept-Encoding")
+    if compressed:
+        request.setHeader("content-encoding", "gzip")
+    request.write(body)
+
+
+def get_range(request, size):
+    """
+    Returns the (first, last) byte positions of the response body selected by the
+    request's Range header, the whole body if there isn't one (or it asks for more
+    than one range, which we don't support), or `None` if the range is unsatisfiable.
+    """
+    header = request.getHeader("range")
+    if size == 0:
+        # no range of an empty body is satisfiable, so send it whole
+        return 0, -1
+    if header is None or not header.startswith("bytes=") or "," in header:
+        return 0, size - 1
+    try:
+        first, last = header[len("bytes="):].split("-")
+        if first == "":
+            first, last = max(size - int(last), 0), size - 1
+        else:
+            first, last = int(first), min(int(last), size - 1) if last != "" else size - 1
+    except ValueError:
+        return 0, size - 1
+    if first > last or first >= size:
+        return None
+    return first, last
+
+
+class LimitedFile(object):
+    """
+    Wraps a file so reads stop after `length` bytes, for sending part of a file with
+    `FileSender`.
+    """
+
+    def __init__(self, f, length):
+        self.f = f
+        self.remaining = length
+
+    def read(self, size):
+        data = self.f.read(min(size, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+
+def hash_file(f, chunk_size=65536):
+    """
+    Hashes `f` from the start in chunks so it's never held in memory all at once.
+    Returns: the hex encoded `digest` of the contents.
+    """
+    h = hashlib.sha256()
+    f.seek(0)
+    chunk = f.read(chunk_size)
+    while chunk:
+        h.update(chunk)
+        chunk = f.read(chunk_size)
+    return hashlib.new("ripemd160", h.digest()).digest().encode("hex")
+
+
+def spool_upload(f=None, max_size=None, chunk_size=65536):
+    """
+    Returns a new temporary file in the media folder for an upload, with `f` copied
+    into it if given. The files are named so `remove_stale_uploads` can find any that
+    are left behind. Raises an exception if `f` is more than `max_size` bytes long.
+    """
+    outfile = tempfile.NamedTemporaryFile(dir=DATA_FOLDER + "store/media/", prefix=UPLOAD_PREFIX, delete=False)
+    if f is not None:
+        try:
+            f.seek(0)
+            size = 0
+            chunk = f.read(chunk_size)
+            while chunk:
+                size += len(chunk)
+                if size > max_size:
+                    raise Exception("image is larger than %s bytes" % max_size)
+                outfile.write(chunk)
+                chunk = f.read(chunk_size)
+            outfile.flush()
+        except Exception:
+            outfile.close()
+            os.remove(outfile.name)
+            raise
+    return outfile
+
+
+def remove_stale_uploads():
+    """
+    Deletes uploads left in the media folder by requests that never finished, for
+    example because the daemon was stopped while they were being received.
+    """
+    folder = DATA_FOLDER + "store/media/"
+    if os.path.isdir(folder):
+        for name in os.listdir(folder):
+            if name.startswith(UPLOAD_PREFIX):
+                try:
+                    os.remove(folder + name)
+                except OSError:
+                    pass
+
+
+class UploadRequest(server.Request):
+    """
+    A `Request` that refuses image uploads (POST /api/v1/images) over `MAX_UPLOAD_SIZE`
+    before their body is buffered. A Content-Length over the limit is answered with
+    413 as soon as the headers are in, and a body sent without one is cut off once
+    it goes over. The body of an accepted upload is spooled to a named temporary
+    file in the media folder so the handler can hash it and rename it into place
+    without copying it. The API's `Site` should use this as its `requestFactory`;
+    without it uploads still work but are buffered by Twisted and copied.
+    """
+
+    upload = False
+
+    def gotLength(self, length):
+        self.upload = self.channel._command == "POST" and \
+            self.channel._path.split("?")[0] == "/api/v1/images"
+        if not self.upload:
+            return server.Request.gotLength(self, length)
+        self.received = 0
+        if length is not None and length > MAX_UPLOAD_SIZE:
+            self.content = None
+            self._refuse()
+        else:
+            self.content = spool_upload()
+
+    def handleContentChunk(self, data):
+        if not self.upload:
+            return server.Request.handleContentChunk(self, data)
+        if self.content is None:
+            return
+        self.received += len(data)
+        if self.received > MAX_UPLOAD_SIZE:
+            self.discard_upload()
+            self._refuse()
+        else:
+            self.content.write(data)
+
+    def requestReceived(self, command, path, version):
+        # a refused upload whose body was already buffered has nothing to handle
+        if not self.upload or self.content is not None:
+            server.Request.requestReceived(self, command, path, version)
+
+    def discard_upload(self):
+        """
+        Deletes the spooled upload, if it hasn't been moved into place.
+        """
+        if self.upload and self.content is not None:
+            self.content.close()
+            if os.path.exists(self.content.name):
+                os.remove(self.content.name)
+            self.content = None
+
+    def connectionLost(self, reason):
+        self.discard_upload()
+        server.Request.connectionLost(self, reason)
+
+    def _refuse(self):
+        # the request line hasn't been handed to the request yet, so the response is written directly
+        body = json.dumps({"success": False, "reason": "image is larger than %s bytes" % MAX_UPLOAD_SIZE})
+        self.channel.transport.write("HTTP/1.1 413 Request Entity Too Large\r\n"
+                                     "Content-Type: application/json\r\n"
+                                     "Content-Length: %s\r\n"
+                                     "Connection: close\r\n\r\n%s" % (len(body), body))
+        self.channel.transport.loseConnection()
+
+
+_pool = None
+
+
+def start_pool():
+    """
+    Starts the pool of worker processes used by `process_map`. The pool forks the
+    daemon, so this is called when the API is created, before the reactor runs and
+    starts its threads. The pool is kept for the life of the reactor.
+    """
+    global _pool
+    if _pool is None:
+        _pool = Pool()
+        reactor.addSystemEventTrigger("before", "shutdown", _pool.terminate)
+    return _pool
+
+
+def process_map(func, arg_tuples, timeout=PROCESS_TIMEOUT):
+    """
+    Calls `func` with each tuple of arguments in the pool of worker processes. Its
+    results are waited on from the reactor's thread pool so the reactor never blocks,
+    for at most `timeout` seconds each so a hung worker can't hold a thread forever.
+    `func` must be a module level function and its arguments picklable.
+    Returns a `Deferred` that fires with the list of results.
+    """
+    def wait():
+        try:
+            return [r.get(timeout) for r in results]
+        except TimeoutError:
+            raise Exception("a worker process didn't respond within %s seconds" % timeout)
+    results = [start_pool().apply_async(func, args) for args in arg_tuples]
+    return threads.deferToThread(wait)
+
+
 class OpenBazaarAPI(APIResource):
     """
     This RESTful API allows clients to pull relevant data from the
@@ -46,41 +417,78 @@ class OpenBazaarAPI(APIResource):
         self.protocol = protocol
         self.db = mserver.db
         self.keychain = KeyChain(self.db)
+        self.log = Logger(system=self)
+        self.keyword_publisher = KeywordPublisher(kserver, self.keychain)
+        self.keyword_publisher.load(self.db)
+        self.resolver = NodeResolver(kserver)
+        self._listings_response = None
+        self.listing_index = ListingIndex(self.db)
+        self.listing_index.load()
+        remove_stale_uploads()
+        start_pool()
+        self.image_cache = LRUCache(IMAGE_CACHE_SIZE)
+        self.remote_cache = DiskCache(DATA_FOLDER + "cache/", REMOTE_CACHE_SIZE)
+        self.remote_fetches = RequestCoalescer()
+        self.remote_data = StaleWhileRevalidateCache(DATA_FOLDER + "remote_cache/")
+        add_listing_listener(self._listing_changed)
+        add_listing_listener(self.listing_index.update)
+        self.conversations = ConversationSummary(self.db)
+        self.mserver.protocol.add_listener(self.conversations)
+        self.mserver.protocol.add_listener(MessagePublisher())
         APIResource.__init__(self)
 
+    def _listing_changed(self, contract, metadata):
+        self._listings_response = None
+
     @GET('^/api/v1/get_image')
     def get_image(self, request):
-        @defer.inlineCallbacks
+        """
+        Images are addressed by their hash so they never change. The hash is used as
+        the ETag, responses may be cached forever and single byte ranges are supported.
+        Small images are kept in memory since listing grids request the same thumbnails
+        over and over. Passing `size` (small, medium or large) returns a thumbnail of
+        one of our own images if one was made when it was uploaded. Until it's made the
+        original is returned with a different ETag and only cached briefly.
+        """
         def _showImage(resp=None):
-            @defer.inlineCallbacks
-            def _setContentDispositionAndSend(file_path, extension, content_type):
-                request.setHeader('content-disposition', 'filename="%s.%s"' % (file_path, extension))
-                request.setHeader('content-type', content_type)
-
-                f = open(file_path, "rb")
-                yield FileSender().beginFileTransfer(f, request)
-                f.close()
-                defer.returnValue(0)
-
-            if os.path.exists(image_path):
-                yield _setContentDispositionAndSend(image_path, "jpg", "image/jpeg")
+            if image_key in self.image_cache or os.path.exists(image_path):
+                self._send_image(request, image_key, image_path, cache_control)
             else:
                 request.setResponseCode(http.NOT_FOUND)
                 request.write("No such image '%s'" % request.path)
-            request.finish()
+                request.finish()
 
         if "hash" in request.args and len(request.args["hash"][0]) == 40:
-            if self.db.HashMap().get_file(request.args["hash"][0]) is not None:
-                image_path = self.db.HashMap().get_file(request.args["hash"][0])
-            else:
-                image_path = DATA_FOLDER + "cache/" + request.args["hash"][0]
-            if not os.path.exists(image_path) and "guid" in request.args:
-                def get_node(node):
-                    if node is not None:
-                        self.mserver.get_image(node, unhexlify(request.args["hash"][0])).addCallback(_showImage)
-                    else:
-                        _showImage()
-                self.kserver.resolve(unhexlify(request.args["guid"][0])).addCallback(get_node)
+            image_hash = image_key = request.args["hash"][0]
+            image_path = None
+            etag = '"%s"' % image_hash
+            cache_control = IMAGE_CACHE_CONTROL
+            if "size" in request.args:
+                image_path = self.db.HashMap().get_file(thumbnail_key(image_hash, request.args["size"][0]))
+                if image_path is not None:
+                    image_key = thumbnail_key(image_hash, request.args["size"][0])
+                    etag = '"%s"' % image_key
+                else:
+                    # the original stands in until the thumbnail is made, so it mustn't be
+                    # cached as the thumbnail
+                    etag = '"%s:original"' % image_key
+                    cache_control = THUMBNAIL_FALLBACK_CACHE_CONTROL
+            if request.setETag(etag) == http.CACHED:
+                request.setHeader('cache-control', cache_control)
+                request.finish()
+                return server.NOT_DONE_YET
+            if image_path is None:
+                image_path = self.db.HashMap().get_file(image_hash)
+            if image_path is None:
+                image_path = DATA_FOLDER + "cache/" + image_hash
+            if image_key in self.image_cache or os.path.exists(image_path):
+                if image_path == DATA_FOLDER + "cache/" + image_hash:
+                    self.remote_cache.touch(image_hash)
+                _showImage()
+            elif "guid" in request.args:
+                self.remote_fetches.run(("image", image_hash), self._fetch_remote,
+                                        self.mserver.get_image, request.args["guid"][0], image_hash)\
+                    .addBoth(_showImage)
             else:
                 _showImage()
         else:
@@ -89,6 +497,70 @@ class OpenBazaarAPI(APIResource):
 
         return server.NOT_DONE_YET
 
+    def _fetch_remote(self, fetch, guid, hash_value):
+        """
+        Fetches an image or contract from the node with the given guid, which caches it
+        in DATA_FOLDER/cache, and adds it to the cache's size budget. This is run through
+        `self.remote_fetches` so concurrent requests for the same hash share one fetch.
+        Args:
+            fetch: `self.mserver.get_image` or `self.mserver.get_contract`.
+            guid: the hex encoded guid of the node to fetch from.
+            hash_value: the hex encoded hash of the image or contract.
+        """
+        def get_node(node):
+            if node is None:
+                return None
+            return fetch(node, unhexlify(hash_value)).addCallback(self.resolver.check_response, node)\
+                .addCallback(cached)
+
+        def cached(result):
+            if result is not None:
+                self.remote_cache.add(hash_value)
+            return result
+
+        return self.resolver.resolve(unhexlify(guid)).addCallback(get_node)
+
+    def _send_image(self, request, image_key, image_path, cache_control=IMAGE_CACHE_CONTROL):
+        request.setHeader('content-disposition', 'filename="%s.jpg"' % image_path)
+        request.setHeader('content-type', "image/jpeg")
+        request.setHeader('cache-control', cache_control)
+        request.setHeader('accept-ranges', "bytes")
+
+        data = self.image_cache.get(image_key)
+        if data is None:
+            size = os.path.getsize(image_path)
+            if size <= MAX_CACHED_IMAGE_SIZE:
+                with open(image_path, "rb") as f:
+                    data = f.read()
+                self.image_cache.put(image_key, data)
+        else:
+            size = len(data)
+
+        byte_range = get_range(request, size)
+        if byte_range is None:
+            request.setResponseCode(http.REQUESTED_RANGE_NOT_SATISFIABLE)
+            request.setHeader('content-range', "bytes */%s" % size)
+            request.finish()
+            return
+        start, end = byte_range
+        if end - start + 1 < size:
+            request.setResponseCode(http.PARTIAL_CONTENT)
+            request.setHeader('content-range', "bytes %s-%s/%s" % (start, end, size))
+        request.setHeader('content-length', str(end - start + 1))
+
+        if data is not None:
+            request.write(data[start:end + 1])
+            request.finish()
+        else:
+            f = open(image_path, "rb")
+            f.seek(start)
+            d = FileSender().beginFileTransfer(LimitedFile(f, end - start + 1), request)
+
+            def done(result):
+                f.close()
+                request.finish()
+            d.addBoth(done)
+
     @GET('^/api/v1/profile')
     def get_profile(self, request):
         def parse_profile(profile):
@@ -129,75 +601,120 @@ class OpenBazaarAPI(APIResource):
                             "username": account.username,
                             "proof_url": account.proof_url
                         }
-                request.setHeader('content-type', "application/json")
-                request.write(json.dumps(profile_json, indent=4))
+                write_response(request, profile_json)
                 request.finish()
             else:
-                request.write(json.dumps({}))
+                write_response(request, {})
                 request.finish()
         if "guid" in request.args:
-            def get_node(node):
-                if node is not None:
-                    self.mserver.get_profile(node).addCallback(parse_profile)
-                else:
-                    request.write(json.dumps({}))
-                    request.finish()
-            self.kserver.resolve(unhexlify(request.args["guid"][0])).addCallback(get_node)
+            self._get_remote("profile", request.args["guid"][0], self.mserver.get_profile, objects.Profile)\
+                .addCallbacks(parse_profile, lambda failure: parse_profile(None))
         else:
             parse_profile(Profile(self.db).get())
         return server.NOT_DONE_YET
 
+    def _get_remote(self, kind, guid, rpc, proto_class):
+        """
+        Gets a profile, listings, followers or following from the node with the given
+        guid through `self.remote_data`, which answers from its cache when it can.
+        Args:
+            kind: the name the result is cached under.
+            guid: the hex encoded guid of the node.
+            rpc: the `self.mserver` method that fetches it from the node.
+            proto_class: the protobuf class of the result.
+        """
+        guid = unhexlify(guid).encode("hex")
+
+        def fetch():
+            def get_node(node):
+                if node is None:
+                    return None
+                return rpc(node).addCallback(self.resolver.check_response, node)
+            return self.resolver.resolve(unhexlify(guid)).addCallback(get_node)
+        return self.remote_data.get(kind, guid, fetch, proto_class)
+
     @GET('^/api/v1/get_listings')
     def get_listings(self, request):
         def parse_listings(listings):
             if listings is not None:
-                response = {"listings": []}
-                for l in listings.listing:
-                    listing_json = {
-                        "title": l.title,
-                        "contract_hash": l.contract_hash.encode("hex"),
-                        "thumbnail_hash": l.thumbnail_hash.encode("hex"),
-                        "category": l.category,
-                        "price": l.price,
-                        "currency_code": l.currency_code,
-                        "nsfw": l.nsfw,
-                        "origin": str(CountryCode.Name(l.origin)),
-                        "ships_to": []
-                    }
-                    for country in l.ships_to:
-                        listing_json["ships_to"].append(str(CountryCode.Name(country)))
-                    response["listings"].append(listing_json)
-                request.setHeader('content-type', "application/json")
-                request.write(json.dumps(response, indent=4))
+                page, next_cursor = get_page(request, listings.listing, lambda l: l.contract_hash)
+                response = {"listings": [listing_to_json(l) for l in page]}
+                if is_paged(request):
+                    response["next_cursor"] = next_cursor
+                write_response(request, response)
                 request.finish()
             else:
-                request.write(json.dumps({}))
+                write_response(request, {})
                 request.finish()
 
         if "guid" in request.args:
-            def get_node(node):
-                if node is not None:
-                    self.mserver.get_listings(node).addCallback(parse_listings)
-                else:
-                    request.write(json.dumps({}))
-                    request.finish()
-            self.kserver.resolve(unhexlify(request.args["guid"][0])).addCallback(get_node)
+            self._get_remote("listings", request.args["guid"][0], self.mserver.get_listings, objects.Listings)\
+                .addCallbacks(parse_listings, lambda failure: parse_listings(None))
         else:
-            ser = self.db.ListingsStore().get_proto()
-            if ser is not None:
-                l = objects.Listings()
-                l.ParseFromString(ser)
+            # Our own listings only change through `Contract.save` and `Contract.delete` so
+            # the rendered response is kept until one of them tells us otherwise.
+            if self._listings_response is None:
+                ser = self.db.ListingsStore().get_proto()
+                if ser is not None:
+                    l = objects.Listings()
+                    l.ParseFromString(ser)
+                    response = listings_to_json(l)
+                else:
+                    l = None
+                    response = {}
+                # weak, since the same tag is sent for every encoding of the response
+                etag = 'W/"%s"' % digest(json.dumps(response, sort_keys=True)).encode("hex")
+                self._listings_response = (l, response, etag, {})
+            l, response, etag, encoded = self._listings_response
+            if l is not None and is_paged(request):
                 parse_listings(l)
             else:
-                parse_listings(None)
+                if request.setETag(etag) != http.CACHED:
+                    write_response(request, response, encoded)
+                request.finish()
+        return server.NOT_DONE_YET
+
+    @GET('^/api/v1/search')
+    def search(self, request):
+        """
+        Searches our own listings. `min_price` and `max_price` need a `currency_code`.
+        """
+        def do_search(_):
+            total, listings, facets = self.listing_index.search(
+                query=request.args["q"][0] if "q" in request.args else None,
+                min_price=float(request.args["min_price"][0]) if "min_price" in request.args else None,
+                max_price=float(request.args["max_price"][0]) if "max_price" in request.args else None,
+                offset=int(request.args["offset"][0]) if "offset" in request.args else DEFAULT_RECORDS_OFFSET,
+                limit=int(request.args["limit"][0]) if "limit" in request.args else DEFAULT_RECORDS_COUNT,
+                category=request.args["category"][0] if "category" in request.args else None,
+                currency_code=request.args["currency_code"][0] if "currency_code" in request.args else None,
+                origin=request.args["origin"][0] if "origin" in request.args else None,
+                ships_to=request.args["ships_to"] if "ships_to" in request.args else None,
+                nsfw=str_to_bool(request.args["nsfw"][0]) if "nsfw" in request.args else None)
+            response = {
+                "total": total,
+                "listings": [listing_to_json(l) for l in listings],
+                "facets": facets
+            }
+            write_response(request, response)
+            request.finish()
+
+        def search_failed(failure):
+            write_response(request, {"success": False, "reason": failure.getErrorMessage()})
+            request.finish()
+
+        self.listing_index.load().addCallback(do_search).addErrback(search_failed)
         return server.NOT_DONE_YET
 
     @GET('^/api/v1/get_followers')
     def get_followers(self, request):
         def parse_followers(followers):
             if followers is not None:
+                page, next_cursor = get_page(request, followers.followers, lambda f: f.guid)
                 response = {"followers": []}
-                for f in followers.followers:
+                if is_paged(request):
+                    response["next_cursor"] = next_cursor
+                for f in page:
                     follower_json = {
                         "guid": f.guid.encode("hex"),
                         "handle": f.metadata.handle,
@@ -206,20 +723,14 @@ class OpenBazaarAPI(APIResource):
                         "nsfw": f.metadata.nsfw
                     }
                     response["followers"].append(follower_json)
-                request.setHeader('content-type', "application/json")
-                request.write(json.dumps(response, indent=4))
+                write_response(request, response)
                 request.finish()
             else:
-                request.write(json.dumps({}))
+                write_response(request, {})
                 request.finish()
         if "guid" in request.args:
-            def get_node(node):
-                if node is not None:
-                    self.mserver.get_followers(node).addCallback(parse_followers)
-                else:
-                    request.write(json.dumps({}))
-                    request.finish()
-            self.kserver.resolve(unhexlify(request.args["guid"][0])).addCallback(get_node)
+            self._get_remote("followers", request.args["guid"][0], self.mserver.get_followers, objects.Followers)\
+                .addCallbacks(parse_followers, lambda failure: parse_followers(None))
         else:
             ser = self.db.FollowData().get_followers()
             if ser is not None:
@@ -234,8 +745,11 @@ class OpenBazaarAPI(APIResource):
     def get_following(self, request):
         def parse_following(following):
             if following is not None:
+                page, next_cursor = get_page(request, following.users, lambda f: f.guid)
                 response = {"following": []}
-                for f in following.users:
+                if is_paged(request):
+                    response["next_cursor"] = next_cursor
+                for f in page:
                     user_json = {
                         "guid": f.guid.encode("hex"),
                         "handle": f.metadata.handle,
@@ -244,21 +758,15 @@ class OpenBazaarAPI(APIResource):
                         "nsfw": f.metadata.nsfw
                     }
                     response["following"].append(user_json)
-                request.setHeader('content-type', "application/json")
-                request.write(json.dumps(response, indent=4))
+                write_response(request, response)
                 request.finish()
             else:
-                request.write(json.dumps({}))
+                write_response(request, {})
                 request.finish()
 
         if "guid" in request.args:
-            def get_node(node):
-                if node is not None:
-                    self.mserver.get_following(node).addCallback(parse_following)
-                else:
-                    request.write(json.dumps({}))
-                    request.finish()
-            self.kserver.resolve(unhexlify(request.args["guid"][0])).addCallback(get_node)
+            self._get_remote("following", request.args["guid"][0], self.mserver.get_following, objects.Following)\
+                .addCallbacks(parse_following, lambda failure: parse_following(None))
         else:
             ser = self.db.FollowData().get_following()
             if ser is not None:
@@ -275,12 +783,12 @@ class OpenBazaarAPI(APIResource):
             def get_node(node):
                 if node is not None:
                     self.mserver.follow(node)
-                    request.write(json.dumps({"success": True}))
+                    write_response(request, {"success": True})
                     request.finish()
                 else:
-                    request.write(json.dumps({"success": False, "reason": "could not resolve guid"}, indent=4))
+                    write_response(request, {"success": False, "reason": "could not resolve guid"})
                     request.finish()
-            self.kserver.resolve(unhexlify(request.args["guid"][0])).addCallback(get_node)
+            self.resolver.resolve(unhexlify(request.args["guid"][0])).addCallback(get_node)
             return server.NOT_DONE_YET
 
     @POST('^/api/v1/unfollow')
@@ -289,12 +797,12 @@ class OpenBazaarAPI(APIResource):
             def get_node(node):
                 if node is not None:
                     self.mserver.unfollow(node)
-                    request.write(json.dumps({"success": True}))
+                    write_response(request, {"success": True})
                     request.finish()
                 else:
-                    request.write(json.dumps({"success": False, "reason": "could not resolve guid"}, indent=4))
+                    write_response(request, {"success": False, "reason": "could not resolve guid"})
                     request.finish()
-            self.kserver.resolve(unhexlify(request.args["guid"][0])).addCallback(get_node)
+            self.resolver.resolve(unhexlify(request.args["guid"][0])).addCallback(get_node)
             return server.NOT_DONE_YET
 
     # pylint: disable=R0201
@@ -305,7 +813,7 @@ class OpenBazaarAPI(APIResource):
             if not p.get().encryption_key \
                     and "name" not in request.args \
                     and "location" not in request.args:
-                request.write(json.dumps({"success": False, "reason": "name or location not included"}, indent=4))
+                write_response(request, {"success": False, "reason": "name or location not included"})
                 request.finish()
                 return False
             u = objects.Profile()
@@ -354,12 +862,12 @@ class OpenBazaarAPI(APIResource):
             enc.signature = self.keychain.signing_key.sign(enc.public_key)[:64]
             u.encryption_key.MergeFrom(enc)
             p.update(u)
-            request.write(json.dumps({"success": True}))
+            write_response(request, {"success": True})
             request.finish()
             self.kserver.node.vendor = p.get().vendor
             return server.NOT_DONE_YET
         except Exception, e:
-            request.write(json.dumps({"success": False, "reason": e.message}, indent=4))
+            write_response(request, {"success": False, "reason": e.message})
             request.finish()
             return server.NOT_DONE_YET
 
@@ -372,11 +880,11 @@ class OpenBazaarAPI(APIResource):
                                      request.args["proof"][0] if "proof" in request.args else None)
             else:
                 raise Exception("Missing required fields")
-            request.write(json.dumps({"success": True}))
+            write_response(request, {"success": True})
             request.finish()
             return server.NOT_DONE_YET
         except Exception, e:
-            request.write(json.dumps({"success": False, "reason": e.message}, indent=4))
+            write_response(request, {"success": False, "reason": e.message})
             request.finish()
             return server.NOT_DONE_YET
 
@@ -386,11 +894,11 @@ class OpenBazaarAPI(APIResource):
             p = Profile(self.db)
             if "account_type" in request.args:
                 p.remove_social_account(request.args["account_type"][0])
-            request.write(json.dumps({"success": True}))
+            write_response(request, {"success": True})
             request.finish()
             return server.NOT_DONE_YET
         except Exception, e:
-            request.write(json.dumps({"success": False, "reason": e.message}, indent=4))
+            write_response(request, {"success": False, "reason": e.message})
             request.finish()
             return server.NOT_DONE_YET
 
@@ -398,28 +906,24 @@ class OpenBazaarAPI(APIResource):
     def get_contract(self, request):
         def parse_contract(contract):
             if contract is not None:
-                request.setHeader('content-type', "application/json")
-                request.write(json.dumps(contract, indent=4))
+                write_response(request, contract)
                 request.finish()
             else:
-                request.write(json.dumps({}))
+                write_response(request, {})
                 request.finish()
 
         if "id" in request.args and len(request.args["id"][0]) == 40:
             if "guid" in request.args and len(request.args["guid"][0]) == 40:
-                def get_node(node):
-                    if node is not None:
-                        self.mserver.get_contract(node, unhexlify(request.args["id"][0]))\
-                            .addCallback(parse_contract)
-                    else:
-                        request.write(json.dumps({}))
-                        request.finish()
                 try:
                     with open(DATA_FOLDER + "cache/" + request.args["id"][0], "r") as filename:
                         contract = json.loads(filename.read(), object_pairs_hook=OrderedDict)
+                    self.remote_cache.touch(request.args["id"][0])
                     parse_contract(contract)
                 except Exception:
-                    self.kserver.resolve(unhexlify(request.args["guid"][0])).addCallback(get_node)
+                    self.remote_fetches.run(("contract", request.args["id"][0]), self._fetch_remote,
+                                            self.mserver.get_contract, request.args["guid"][0],
+                                            request.args["id"][0])\
+                        .addCallbacks(parse_contract, lambda failure: parse_contract(None))
             else:
                 try:
                     with open(self.db.HashMap().get_file(request.args["id"][0]), "r") as filename:
@@ -428,7 +932,7 @@ class OpenBazaarAPI(APIResource):
                 except Exception:
                     parse_contract(None)
         else:
-            request.write(json.dumps({}))
+            write_response(request, {})
             request.finish()
         return server.NOT_DONE_YET
 
@@ -469,14 +973,13 @@ class OpenBazaarAPI(APIResource):
                 free_shipping=str_to_bool(request.args["free_shipping"][0]),
                 options=options if "options" in request.args else None,
                 moderators=request.args["moderators"] if "moderators" in request.args else None)
-            for keyword in request.args["keywords"]:
-                self.kserver.set(digest(keyword.lower()), c.get_contract_id(),
-                                 self.kserver.node.getProto().SerializeToString())
-            request.write(json.dumps({"success": True, "id": c.get_contract_id().encode("hex")}))
+            if "keywords" in request.args:
+                self.keyword_publisher.publish(request.args["keywords"], c.get_contract_id())
+            write_response(request, {"success": True, "id": c.get_contract_id().encode("hex")})
             request.finish()
             return server.NOT_DONE_YET
         except Exception, e:
-            request.write(json.dumps({"success": False, "reason": e.message}, indent=4))
+            write_response(request, {"success": False, "reason": e.message})
             request.finish()
             return server.NOT_DONE_YET
 
@@ -489,18 +992,105 @@ class OpenBazaarAPI(APIResource):
                     contract = json.load(filename, object_pairs_hook=OrderedDict)
                 c = Contract(self.db, contract=contract)
                 if "keywords" in c.contract["vendor_offer"]["listing"]["item"]:
-                    for keyword in c.contract["vendor_offer"]["listing"]["item"]["keywords"]:
-                        self.kserver.delete(keyword.lower(), c.get_contract_id(),
-                                            self.keychain.signing_key.sign(c.get_contract_id())[:64])
+                    self.keyword_publisher.unpublish(c.contract["vendor_offer"]["listing"]["item"]["keywords"],
+                                                     c.get_contract_id())
                 if "delete_images" in request.args:
                     c.delete(delete_images=True)
                 else:
                     c.delete()
-            request.write(json.dumps({"success": True}))
+            write_response(request, {"success": True})
+            request.finish()
+            return server.NOT_DONE_YET
+        except Exception, e:
+            write_response(request, {"success": False, "reason": e.message})
             request.finish()
             return server.NOT_DONE_YET
+
+    @POST('^/api/v1/import_listings')
+    def import_listings(self, request):
+        """
+        Creates many listings in one request. The body is either a json object of the form
+        {"listings": [...]} or one json listing per line. Each listing takes the same fields
+        as POST /api/v1/contracts. All listings are validated before any are signed, the
+        signing is spread over a process pool, and only then are they saved. If saving
+        one fails the import stops there and `ids` lists the listings that were saved.
+        """
+        try:
+            def save_listings(signatures, contracts, keywords):
+                # if a save fails the listings saved before it are kept, published and reported
+                saved = []
+                error = None
+                for index, (c, sigs, words) in enumerate(zip(contracts, signatures, keywords)):
+                    try:
+                        c.set_listing_signatures(sigs)
+                        c.save()
+                    except Exception, e:
+                        error = "listing %s: %s" % (index, e.message or repr(e))
+                        break
+                    self.keyword_publisher.publish(words, c.get_contract_id())
+                    saved.append(c.get_contract_id().encode("hex"))
+                if error is None:
+                    write_response(request, {"success": True, "ids": saved})
+                else:
+                    write_response(request, {"success": False, "reason": error, "ids": saved})
+                request.finish()
+
+            def import_failed(failure):
+                write_response(request, {"success": False, "reason": failure.getErrorMessage()})
+                request.finish()
+
+            body = request.content.read()
+            try:
+                listings = json.loads(body)["listings"]
+            except (ValueError, KeyError, TypeError):
+                listings = [json.loads(line) for line in body.splitlines() if line.strip()]
+
+            contracts = []
+            keywords = []
+            for index, listing in enumerate(encode_utf8(listings)):
+                try:
+                    c = Contract(self.db)
+                    c.create(
+                        str(listing["expiration_date"]),
+                        listing["metadata_category"],
+                        listing["title"],
+                        listing["description"],
+                        listing["currency_code"],
+                        listing["price"],
+                        listing["process_time"],
+                        str_to_bool(str(listing["nsfw"])),
+                        shipping_origin=listing.get("shipping_origin"),
+                        shipping_regions=listing.get("ships_to"),
+                        est_delivery_domestic=listing.get("est_delivery_domestic"),
+                        est_delivery_international=listing.get("est_delivery_international"),
+                        terms_conditions=listing.get("terms_conditions") or None,
+                        returns=listing.get("returns") or None,
+                        shipping_currency_code=listing.get("shipping_currency_code"),
+                        shipping_domestic=listing.get("shipping_domestic"),
+                        shipping_international=listing.get("shipping_international"),
+                        keywords=listing.get("keywords"),
+                        category=listing.get("category") or None,
+                        condition=listing.get("condition") or None,
+                        sku=listing.get("sku") or None,
+                        images=listing.get("images"),
+                        free_shipping=str_to_bool(str(listing.get("free_shipping", True))),
+                        options=listing.get("options"),
+                        moderators=listing.get("moderators"),
+                        commit=False)
+                except Exception, e:
+                    raise Exception("listing %s: %s" % (index, e.message or repr(e)))
+                contracts.append(c)
+                keywords.append(listing.get("keywords") or [])
+
+            signing_key = self.keychain.signing_key.encode()
+            bitcoin_privkey = bitcoin.bip32_extract_key(self.keychain.bitcoin_master_privkey)
+            d = process_map(sign_listing, [(json.dumps(c.contract["vendor_offer"]["listing"], indent=4),
+                                            signing_key, bitcoin_privkey) for c in contracts])
+            d.addCallback(save_listings, contracts, keywords)
+            d.addErrback(import_failed)
+            return server.NOT_DONE_YET
         except Exception, e:
-            request.write(json.dumps({"success": False, "reason": e.message}, indent=4))
+            write_response(request, {"success": False, "reason": e.message})
             request.finish()
             return server.NOT_DONE_YET
 
@@ -514,11 +1104,11 @@ class OpenBazaarAPI(APIResource):
     def make_moderator(self, request):
         try:
             self.mserver.make_moderator()
-            request.write(json.dumps({"success": True}))
+            write_response(request, {"success": True})
             request.finish()
             return server.NOT_DONE_YET
         except Exception, e:
-            request.write(json.dumps({"success": False, "reason": e.message}, indent=4))
+            write_response(request, {"success": False, "reason": e.message})
             request.finish()
             return server.NOT_DONE_YET
 
@@ -526,57 +1116,70 @@ class OpenBazaarAPI(APIResource):
     def unmake_moderator(self, request):
         try:
             self.mserver.unmake_moderator()
-            request.write(json.dumps({"success": True}))
+            write_response(request, {"success": True})
             request.finish()
             return server.NOT_DONE_YET
         except Exception, e:
-            request.write(json.dumps({"success": False, "reason": e.message}, indent=4))
+            write_response(request, {"success": False, "reason": e.message})
             request.finish()
             return server.NOT_DONE_YET
 
     @POST('^/api/v1/purchase_contract')
     def purchase_contract(self, request):
         try:
-            def handle_response(resp, contract):
+            def handle_response(resp, contract, payment):
                 if resp:
                     contract.await_funding(self.mserver.protocol.get_notification_listener(),
                                            self.protocol.blockchain, resp)
-                    request.write(json.dumps({"success": True, "payment_address": payment[0],
-                                              "amount": payment[1],
-                                              "order_id": c.get_contract_id().encode("hex")},
-                                             indent=4))
+                    write_response(request, {"success": True, "payment_address": payment[0],
+                                             "amount": payment[1],
+                                             "order_id": contract.get_contract_id().encode("hex")})
                     request.finish()
                 else:
-                    request.write(json.dumps({"success": False, "reason": "seller rejected contract"}, indent=4))
+                    write_response(request, {"success": False, "reason": "seller rejected contract"})
                     request.finish()
+
+            def send_order(payment, contract):
+                def get_node(node):
+                    if node is not None:
+                        self.mserver.purchase(node, contract).addCallback(self.resolver.check_response, node)\
+                            .addCallback(handle_response, contract, payment)
+                    else:
+                        write_response(request, {"success": False, "reason": "unable to reach vendor"})
+                        request.finish()
+                if not payment:
+                    write_response(request, {"success": False, "reason": "unable to create order"})
+                    request.finish()
+                    return
+                seller_guid = unhexlify(contract.contract["vendor_offer"]["listing"]["id"]["guid"])
+                self.resolver.resolve(seller_guid).addCallback(get_node)
+
+            def order_failed(failure):
+                write_response(request, {"success": False, "reason": failure.getErrorMessage()})
+                request.finish()
+
             options = None
             if "options" in request.args:
                 options = {}
                 for option in request.args["options"]:
                     options[option] = request.args[option][0]
             c = Contract(self.db, hash_value=unhexlify(request.args["id"][0]), testnet=self.protocol.testnet)
-            payment = c.\
-                add_purchase_info(int(request.args["quantity"][0]),
-                                  request.args["ship_to"][0] if "ship_to" in request.args else None,
-                                  request.args["address"][0] if "address" in request.args else None,
-                                  request.args["city"][0] if "city" in request.args else None,
-                                  request.args["state"][0] if "state" in request.args else None,
-                                  request.args["postal_code"][0] if "postal_code" in request.args else None,
-                                  request.args["country"][0] if "country" in request.args else None,
-                                  request.args["moderator"][0] if "moderator" in request.args else None,
-                                  options)
-
-            def get_node(node):
-                if node is not None:
-                    self.mserver.purchase(node, c).addCallback(handle_response, c)
-                else:
-                    request.write(json.dumps({"success": False, "reason": "unable to reach vendor"}, indent=4))
-                    request.finish()
-            seller_guid = unhexlify(c.contract["vendor_offer"]["listing"]["id"]["guid"])
-            self.kserver.resolve(seller_guid).addCallback(get_node)
+            d = c.add_purchase_info_async(
+                int(request.args["quantity"][0]),
+                request.args["refund_address"][0],
+                request.args["ship_to"][0] if "ship_to" in request.args else None,
+                request.args["address"][0] if "address" in request.args else None,
+                request.args["city"][0] if "city" in request.args else None,
+                request.args["state"][0] if "state" in request.args else None,
+                request.args["postal_code"][0] if "postal_code" in request.args else None,
+                request.args["country"][0] if "country" in request.args else None,
+                request.args["moderator"][0] if "moderator" in request.args else None,
+                options)
+            d.addCallback(send_order, c)
+            d.addErrback(order_failed)
             return server.NOT_DONE_YET
         except Exception, e:
-            request.write(json.dumps({"success": False, "reason": e.message}, indent=4))
+            write_response(request, {"success": False, "reason": e.message})
             request.finish()
             return server.NOT_DONE_YET
 
@@ -585,12 +1188,12 @@ class OpenBazaarAPI(APIResource):
         try:
             def respond(success):
                 if success:
-                    request.write(json.dumps({"success": True}))
+                    write_response(request, {"success": True})
                     request.finish()
                 else:
-                    request.write(json.dumps({"success": False, "reason": "Failed to send order confirmation"}))
+                    write_response(request, {"success": False, "reason": "Failed to send order confirmation"})
                     request.finish()
-            file_path = DATA_FOLDER + "store/listings/in progress/" + request.args["id"][0] + ".json"
+            file_path = OrderIndex(self.db).get_file(request.args["id"][0])
             with open(file_path, 'r') as filename:
                 order = json.load(filename, object_pairs_hook=OrderedDict)
             c = Contract(self.db, contract=order, testnet=self.protocol.testnet)
@@ -608,7 +1211,7 @@ class OpenBazaarAPI(APIResource):
             self.mserver.confirm_order(guid, c).addCallback(respond)
             return server.NOT_DONE_YET
         except Exception, e:
-            request.write(json.dumps({"success": False, "reason": e.message}, indent=4))
+            write_response(request, {"success": False, "reason": e.message})
             request.finish()
             return server.NOT_DONE_YET
 
@@ -616,13 +1219,16 @@ class OpenBazaarAPI(APIResource):
     def upload_image(self, request):
         try:
             ret = []
+            uploaded = []
             if "image" in request.args:
                 for image in request.args["image"]:
                     img = image.decode('base64')
                     hash_value = digest(img).encode("hex")
-                    with open(DATA_FOLDER + "store/media/" + hash_value, 'wb') as outfile:
-                        outfile.write(img)
-                    self.db.HashMap().insert(hash_value, DATA_FOLDER + "store/media/" + hash_value)
+                    if not self._have_image(hash_value):
+                        with open(DATA_FOLDER + "store/media/" + hash_value, 'wb') as outfile:
+                            outfile.write(img)
+                        self.db.HashMap().insert(hash_value, DATA_FOLDER + "store/media/" + hash_value)
+                        uploaded.append((hash_value, DATA_FOLDER + "store/media/" + hash_value))
                     ret.append(hash_value)
             elif "avatar" in request.args:
                 avi = request.args["avatar"][0].decode("base64")
@@ -630,6 +1236,7 @@ class OpenBazaarAPI(APIResource):
                 with open(DATA_FOLDER + "store/avatar", 'wb') as outfile:
                     outfile.write(avi)
                 self.db.HashMap().insert(hash_value, DATA_FOLDER + "store/avatar")
+                uploaded.append((hash_value, DATA_FOLDER + "store/avatar"))
                 ret.append(hash_value)
             elif "header" in request.args:
                 hdr = request.args["header"][0].decode("base64")
@@ -637,25 +1244,94 @@ class OpenBazaarAPI(APIResource):
                 with open(DATA_FOLDER + "store/header", 'wb') as outfile:
                     outfile.write(hdr)
                 self.db.HashMap().insert(hash_value, DATA_FOLDER + "store/header")
+                uploaded.append((hash_value, DATA_FOLDER + "store/header"))
                 ret.append(hash_value)
-            request.write(json.dumps({"success": True, "image_hashes": ret}, indent=4))
+            self._make_thumbnails(uploaded)
+            write_response(request, {"success": True, "image_hashes": ret})
             request.finish()
             return server.NOT_DONE_YET
         except Exception, e:
-            request.write(json.dumps({"success": False, "reason": e.message}, indent=4))
+            write_response(request, {"success": False, "reason": e.message})
             request.finish()
             return server.NOT_DONE_YET
 
+    @POST('^/api/v1/images')
+    def images(self, request):
+        """
+        Uploads one image sent as the raw request body rather than base64 encoded in a
+        form field. `UploadRequest` spools the body to a file in the media folder and
+        refuses it if it's over `MAX_UPLOAD_SIZE`; here it's hashed in chunks on a
+        worker thread and renamed into place, so it's never decoded or copied. If the
+        site doesn't use `UploadRequest` the body Twisted buffered is copied to such a
+        file first. An image we already have isn't written again.
+        Returns the same response as /api/v1/upload_image.
+        """
+        def spool():
+            if isinstance(request, UploadRequest):
+                upload = request.content
+            else:
+                upload = spool_upload(request.content, MAX_UPLOAD_SIZE)
+            upload.close()
+            with open(upload.name, "rb") as f:
+                return hash_file(f), upload.name
+
+        def store(result):
+            hash_value, tmp_path = result
+            if self._have_image(hash_value):
+                os.remove(tmp_path)
+            else:
+                file_path = DATA_FOLDER + "store/media/" + hash_value
+                os.rename(tmp_path, file_path)
+                self.db.HashMap().insert(hash_value, file_path)
+                self._make_thumbnails([(hash_value, file_path)])
+            write_response(request, {"success": True, "image_hashes": [hash_value]})
+            request.finish()
+
+        def failed(failure):
+            if isinstance(request, UploadRequest):
+                request.discard_upload()
+            write_response(request, {"success": False, "reason": failure.getErrorMessage()})
+            request.finish()
+
+        threads.deferToThread(spool).addCallbacks(store, failed)
+        return server.NOT_DONE_YET
+
+    def _have_image(self, hash_value):
+        file_path = self.db.HashMap().get_file(hash_value)
+        return file_path is not None and os.path.exists(file_path)
+
+    def _make_thumbnails(self, images):
+        """
+        Makes thumbnails of the uploaded (hash, file path) images in worker processes
+        and records them in the `HashMap`. Thumbnails are named after the image's hash
+        (`store/media/<hash>_<size>`), not its path, so re-uploading an avatar or
+        header doesn't change what an older hash's thumbnails point at. The upload
+        doesn't wait for them; until they're done `get_image` serves the original for
+        any size.
+        """
+        def record(results):
+            for (image_hash, file_path), thumbnails in zip(images, results):
+                for size, thumbnail_path in thumbnails:
+                    self.db.HashMap().insert(thumbnail_key(image_hash, size), thumbnail_path)
+
+        def failed(failure):
+            self.log.warning("Failed to make thumbnails: %s" % failure.getErrorMessage())
+
+        if images:
+            process_map(make_thumbnails, [(file_path, DATA_FOLDER + "store/media/" + image_hash)
+                                          for image_hash, file_path in images]) \
+                .addCallbacks(record, failed)
+
     @POST('^/api/v1/complete_order')
     def complete_order(self, request):
         def respond(success):
             if success:
-                request.write(json.dumps({"success": True}))
+                write_response(request, {"success": True})
                 request.finish()
             else:
-                request.write(json.dumps({"success": False, "reason": "Failed to send receipt to vendor"}))
+                write_response(request, {"success": False, "reason": "Failed to send receipt to vendor"})
                 request.finish()
-        file_path = DATA_FOLDER + "purchases/in progress/" + request.args["id"][0] + ".json"
+        file_path = OrderIndex(self.db).get_file(request.args["id"][0])
         with open(file_path, 'r') as filename:
             order = json.load(filename, object_pairs_hook=OrderedDict)
         c = Contract(self.db, contract=order, testnet=self.protocol.testnet)
@@ -692,11 +1368,11 @@ class OpenBazaarAPI(APIResource):
                 request.args["terms_conditions"][0],
                 request.args["refund_policy"][0]
             )
-            request.write(json.dumps({"success": True}, indent=4))
+            write_response(request, {"success": True})
             request.finish()
             return server.NOT_DONE_YET
         except Exception, e:
-            request.write(json.dumps({"success": False, "reason": e.message}, indent=4))
+            write_response(request, {"success": False, "reason": e.message})
             request.finish()
             return server.NOT_DONE_YET
 
@@ -704,7 +1380,7 @@ class OpenBazaarAPI(APIResource):
     def get_settings(self, request):
         settings = self.db.Settings().get()
         if settings is None:
-            request.write(json.dumps({}, indent=4))
+            write_response(request, {})
             request.finish()
         else:
             settings_json = {
@@ -722,13 +1398,13 @@ class OpenBazaarAPI(APIResource):
                 "terms_conditions": settings[12],
                 "refund_policy": settings[13]
             }
-            request.write(json.dumps(settings_json, indent=4))
+            write_response(request, settings_json)
             request.finish()
         return server.NOT_DONE_YET
 
     @GET('^/api/v1/connected_peers')
     def get_connected_peers(self, request):
-        request.write(json.dumps(self.protocol.keys(), indent=4))
+        write_response(request, self.protocol.keys())
         request.finish()
         return server.NOT_DONE_YET
 
@@ -744,16 +1420,31 @@ class OpenBazaarAPI(APIResource):
                     "vendor": node.vendor
                 }
                 nodes.append(n)
-        request.write(json.dumps(nodes, indent=4))
+        write_response(request, nodes)
         request.finish()
         return server.NOT_DONE_YET
 
     @GET('^/api/v1/get_notifications')
     def get_notifications(self, request):
+        # Notifications are paged by id. `before` returns the newest `limit` notifications
+        # older than the given id and `after` the oldest `limit` newer than it, so a client
+        # can walk back through history or poll for new ones without re-reading the rest.
         notifications = self.db.NotificationStore().get_notifications()
-        limit = int(request.args["limit"][0]) if "limit" in request.args else len(notifications)
+        if "unread" in request.args and str_to_bool(request.args["unread"][0]):
+            notifications = [n for n in notifications if n[8] == 0]
+        if "after" in request.args:
+            after = int(request.args["after"][0])
+            notifications = [n for n in notifications if n[0] > after]
+            limit = int(request.args["limit"][0]) if "limit" in request.args else len(notifications)
+            page = notifications[:limit]
+        else:
+            if "before" in request.args:
+                before = int(request.args["before"][0])
+                notifications = [n for n in notifications if n[0] < before]
+            limit = int(request.args["limit"][0]) if "limit" in request.args else len(notifications)
+            page = notifications[max(len(notifications) - limit, 0):]
         notification_list = []
-        for n in notifications[len(notifications) - limit:]:
+        for n in page:
             notification_json = {
                 "id": n[0],
                 "guid": n[1],
@@ -766,20 +1457,27 @@ class OpenBazaarAPI(APIResource):
                 "read": False if n[8] == 0 else True
             }
             notification_list.append(notification_json)
-        request.write(json.dumps(notification_list, indent=4))
+        write_response(request, notification_list)
         request.finish()
         return server.NOT_DONE_YET
 
     @POST('^/api/v1/mark_notification_as_read')
     def mark_notification_as_read(self, request):
         try:
+            # changes to a notification are recorded under "<order id>:<type>", since
+            # that's all events.notify knows about it, so look those up for the read event
+            notif_ids = set(str(notif_id) for notif_id in request.args["id"])
+            keys = dict((str(n[0]), "%s:%s" % (n[4], n[3]))
+                        for n in self.db.NotificationStore().get_notifications() if str(n[0]) in notif_ids)
             for notif_id in request.args["id"]:
                 self.db.NotificationStore().mark_as_read(notif_id)
-            request.write(json.dumps({"success": True}, indent=4))
+                if str(notif_id) in keys:
+                    change_log.record("notification_read", keys[str(notif_id)], {"id": notif_id})
+            write_response(request, {"success": True})
             request.finish()
             return server.NOT_DONE_YET
         except Exception, e:
-            request.write(json.dumps({"success": False, "reason": e.message}, indent=4))
+            write_response(request, {"success": False, "reason": e.message})
             request.finish()
             return server.NOT_DONE_YET
 
@@ -787,23 +1485,51 @@ class OpenBazaarAPI(APIResource):
     def broadcast(self, request):
         try:
             def get_response(num):
-                request.write(json.dumps({"success": True, "peers reached": num}, indent=4))
+                write_response(request, {"success": True, "peers reached": num})
                 request.finish()
             self.mserver.broadcast(request.args["message"][0]).addCallback(get_response)
             return server.NOT_DONE_YET
         except Exception, e:
-            request.write(json.dumps({"success": False, "reason": e.message}, indent=4))
+            write_response(request, {"success": False, "reason": e.message})
             request.finish()
             return server.NOT_DONE_YET
 
     @GET('^/api/v1/get_chat_messages')
     def get_chat_messages(self, request):
+        # Messages are returned newest first, ordered by timestamp and then id. Pass the
+        # timestamp and id of the oldest message received as `before` and `before_id`
+        # to get the page preceding it.
+        def message_id(m):
+            return digest(m[9]).encode("hex")
+
         messages = self.db.MessageStore().get_messages(request.args["guid"][0], "CHAT")
         limit = int(request.args["limit"][0]) if "limit" in request.args else len(messages)
-        start = int(request.args["start"][0]) if "start" in request.args else 0
+        if "before" in request.args:
+            # without an id, only messages older than the timestamp come before it
+            before = (float(request.args["before"][0]),
+                      request.args["before_id"][0] if "before_id" in request.args else "")
+            end = len(messages)
+            while end > 0 and messages[end - 1][7] > before[0]:
+                end -= 1
+            page = []
+            while end > 0 and len(page) < limit:
+                # messages with the same timestamp are ordered by id
+                start = end - 1
+                while start > 0 and messages[start - 1][7] == messages[end - 1][7]:
+                    start -= 1
+                ids = sorted(((m[7], message_id(m), i) for i, m in enumerate(messages[start:end], start)),
+                             reverse=True)
+                page.extend(messages[i] for timestamp, mid, i in ids if (timestamp, mid) < before)
+                end = start
+            page = page[:limit]
+        else:
+            start = int(request.args["start"][0]) if "start" in request.args else 0
+            end = max(len(messages) - start, 0)
+            page = reversed(messages[max(end - limit, 0):end])
         message_list = []
-        for m in messages[::-1][start: start + limit]:
+        for m in page:
             message_json = {
+                "id": message_id(m),
                 "guid": m[0],
                 "handle": m[1],
                 "encryption_key": m[3],
@@ -814,14 +1540,53 @@ class OpenBazaarAPI(APIResource):
                 "read": False if m[11] == 0 else True
             }
             message_list.append(message_json)
-        request.write(json.dumps(message_list, indent=4))
+        write_response(request, message_list)
         request.finish()
         return server.NOT_DONE_YET
 
+    @GET('^/api/v1/changes')
+    def get_changes(self, request):
+        """
+        Returns the latest change to each notification, chat conversation, purchase,
+        sale and case that's changed since the `since` cursor along with the cursor to
+        use next time. At most `limit` changes are returned; if more are available,
+        call again with the returned cursor. If the cursor is older than the changes
+        the log still has, `reset` is returned instead and the client should re-fetch
+        everything and continue from the returned cursor.
+        """
+        try:
+            since = int(request.args["since"][0]) if "since" in request.args else 0
+            limit = int(request.args["limit"][0]) if "limit" in request.args else None
+            changes, cursor = change_log.get_changes(since, limit)
+            if changes is None:
+                write_response(request, {"reset": True, "cursor": cursor})
+            else:
+                write_response(request, {"changes": changes, "cursor": cursor})
+            request.finish()
+            return server.NOT_DONE_YET
+        except Exception, e:
+            write_response(request, {"success": False, "reason": e.message})
+            request.finish()
+            return server.NOT_DONE_YET
+
+    @GET('^/api/v1/events')
+    def events(self, request):
+        """
+        Streams new notifications and chat messages as server-sent events so clients
+        don't need to poll for them. A client that reconnects with the id of the last
+        event it received (in the Last-Event-ID header or a `cursor` argument) is
+        sent the events it missed, or a `reset` event if they're no longer available.
+        """
+        cursor = request.getHeader("last-event-id")
+        if cursor is None and "cursor" in request.args:
+            cursor = request.args["cursor"][0]
+        EventStream(request, cursor=cursor)
+        return server.NOT_DONE_YET
+
     @GET('^/api/v1/get_chat_conversations')
     def get_chat_conversations(self, request):
-        messages = self.db.MessageStore().get_conversations()
-        request.write(json.dumps(messages, indent=4))
+        messages = self.conversations.get_conversations()
+        write_response(request, messages)
         request.finish()
         return server.NOT_DONE_YET
 
@@ -829,10 +1594,12 @@ class OpenBazaarAPI(APIResource):
     def mark_chat_message_as_read(self, request):
         try:
             self.db.MessageStore().mark_as_read(request.args["guid"][0])
-            request.write(json.dumps({"success": True}, indent=4))
+            self.conversations.mark_as_read(request.args["guid"][0])
+            change_log.record("chat_read", request.args["guid"][0])
+            write_response(request, {"success": True})
             request.finish()
             return server.NOT_DONE_YET
         except Exception, e:
-            request.write(json.dumps({"success": False, "reason": e.message}, indent=4))
+            write_response(request, {"success": False, "reason": e.message})
             request.finish()
             return server.NOT_DONE_YET
\ No newline at end of file
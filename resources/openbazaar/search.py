@@ -0,0 +1,196 @@
+import bisect
+import re
+
+from market.contracts import load_listings
+from protos.countries import CountryCode
+from twisted.internet import defer, threads
+
+
+def tokenize(text):
+    """
+    Splits text into the lowercase word tokens used by the index.
+    """
+    if isinstance(text, str):
+        text = text.decode("utf-8", "replace")
+    return set(re.findall(r"\w+", text.lower(), re.UNICODE))
+
+
+class ListingIndex(object):
+    """
+    An in-memory inverted index over our own listings.
+
+    Each listing is indexed by the words in its title and keywords and by its
+    category, currency, origin, ships-to regions and nsfw flag. Prices are kept
+    in a sorted list per currency so range queries don't have to scan every
+    listing. The index is built by `load`, which reads the contracts on a worker
+    thread, and after that is kept up to date by `Contract.save` and
+    `Contract.delete` through `update`.
+    """
+
+    def __init__(self, database):
+        self.db = database
+        self.listings = None
+        self.listing_words = {}
+        self.words = {}
+        self.facets = {}
+        self.prices = {}
+        self._pending = None
+        self._waiters = []
+
+    def load(self):
+        """
+        Build the index, if it isn't built or being built already. Returns a `Deferred`
+        that fires once it's built; `search` must not be called before then.
+        """
+        def build(listings):
+            self.listings = {}
+            for metadata, keywords in listings:
+                self.add(metadata, keywords)
+            # listings saved or deleted while the contracts were being read
+            pending, self._pending = self._pending, None
+            for contract, metadata in pending:
+                self.update(contract, metadata)
+            self._fire_waiters(None)
+
+        def failed(failure):
+            self._pending = None
+            self._fire_waiters(failure)
+
+        if self.listings is not None:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._waiters.append(d)
+        if self._pending is None:
+            self._pending = []
+            threads.deferToThread(load_listings, self.db).addCallbacks(build, failed)
+        return d
+
+    def update(self, contract, metadata):
+        """
+        A listing listener (see `market.contracts.add_listing_listener`).
+        """
+        if self.listings is None:
+            if self._pending is not None:
+                self._pending.append((contract, metadata))
+            return
+        if metadata is None:
+            self.remove(contract.get_contract_id())
+        else:
+            item = contract.contract["vendor_offer"]["listing"]["item"]
+            self.add(metadata, item.get("keywords", []))
+
+    def add(self, metadata, keywords):
+        """
+        Index a `ListingMetadata` protobuf along with the listing's keywords.
+        """
+        contract_hash = metadata.contract_hash
+        self.remove(contract_hash)
+        self.listings[contract_hash] = metadata
+        words = tokenize(metadata.title)
+        for keyword in keywords:
+            words |= tokenize(keyword)
+        self.listing_words[contract_hash] = words
+        for word in words:
+            self.words.setdefault(word, set()).add(contract_hash)
+        for facet, value in self._facet_values(metadata):
+            self.facets.setdefault((facet, value), set()).add(contract_hash)
+        prices = self.prices.setdefault(metadata.currency_code.upper(), [])
+        bisect.insort(prices, (metadata.price, contract_hash))
+
+    def remove(self, contract_hash):
+        metadata = self.listings.pop(contract_hash, None)
+        if metadata is None:
+            return
+        for word in self.listing_words.pop(contract_hash):
+            self.words[word].discard(contract_hash)
+            if not self.words[word]:
+                del self.words[word]
+        for key in self._facet_values(metadata):
+            self.facets[key].discard(contract_hash)
+            if not self.facets[key]:
+                del self.facets[key]
+        prices = self.prices[metadata.currency_code.upper()]
+        del prices[bisect.bisect_left(prices, (metadata.price, contract_hash))]
+
+    def search(self, query=None, min_price=None, max_price=None, offset=0, limit=20, **facets):
+        """
+        Returns the listings matching every given condition.
+        Args:
+            query: free text, every word of which must be in the title or keywords.
+            min_price: only listings priced at or above this, in `currency_code`.
+            max_price: only listings priced at or below this, in `currency_code`.
+            offset: the number of matching listings to skip.
+            limit: the maximum number of listings to return.
+            facets: any of `category`, `currency_code`, `origin`, `ships_to` and `nsfw`
+                mapped to the value to match. `ships_to` may be a list, in which case
+                listings shipping to any of them match.
+        Returns: a tuple of the total number of matches, a page of `ListingMetadata`
+            ordered by title, and the number of matches in each category and currency.
+        Raises: `ValueError` if a price is given without a single `currency_code`,
+            since prices in different currencies can't be compared.
+        """
+        if (min_price is not None or max_price is not None) and \
+                not isinstance(facets.get("currency_code"), basestring):
+            raise ValueError("a price range needs a currency_code")
+        matches = None
+        if query:
+            for word in tokenize(query):
+                matches = self._intersect(matches, self.words.get(word, set()))
+        for facet, value in facets.items():
+            if value is None:
+                continue
+            values = value if isinstance(value, list) else [value]
+            hashes = set()
+            for v in values:
+                hashes |= self.facets.get((facet, self._normalize(facet, v)), set())
+            matches = self._intersect(matches, hashes)
+        if min_price is not None or max_price is not None:
+            prices = self.prices.get(facets["currency_code"].upper(), [])
+            start = 0 if min_price is None else bisect.bisect_left(prices, (min_price,))
+            # "\xff" * 21 sorts after any 20 byte contract hash
+            end = len(prices) if max_price is None else \
+                bisect.bisect_right(prices, (max_price, "\xff" * 21))
+            matches = self._intersect(matches, set(h for p, h in prices[start:end]))
+        if matches is None:
+            matches = set(self.listings)
+
+        counts = {"category": {}, "currency_code": {}}
+        for contract_hash in matches:
+            for facet, value in self._facet_values(self.listings[contract_hash]):
+                if facet in counts:
+                    counts[facet][value] = counts[facet].get(value, 0) + 1
+
+        results = sorted((self.listings[h] for h in matches), key=lambda m: (m.title.lower(), m.contract_hash))
+        return len(results), results[offset:offset + limit], counts
+
+    def _fire_waiters(self, result):
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            if result is None:
+                d.callback(None)
+            else:
+                d.errback(result)
+
+    @staticmethod
+    def _facet_values(metadata):
+        values = [("category", metadata.category.lower()),
+                  ("currency_code", metadata.currency_code.upper()),
+                  ("origin", metadata.origin),
+                  ("nsfw", metadata.nsfw)]
+        for region in set(metadata.ships_to):
+            values.append(("ships_to", region))
+        return values
+
+    @staticmethod
+    def _normalize(facet, value):
+        if facet in ("origin", "ships_to"):
+            return CountryCode.Value(value.upper())
+        elif facet == "category":
+            return value.decode("utf-8").lower() if isinstance(value, str) else value.lower()
+        elif facet == "currency_code":
+            return value.upper()
+        return value
+
+    @staticmethod
+    def _intersect(matches, hashes):
+        return set(hashes) if matches is None else matches & hashes
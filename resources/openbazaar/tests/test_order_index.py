@@ -0,0 +1,80 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from constants import DATA_FOLDER
+from market.contracts import OrderIndex, order_path
+
+
+class FakeHashMap(object):
+    def __init__(self, entries):
+        self.entries = entries
+
+    def get_all(self):
+        return self.entries.items()
+
+    def insert(self, hash_value, file_path):
+        self.entries[hash_value] = file_path
+
+    def delete(self, hash_value):
+        del self.entries[hash_value]
+
+
+class FakeDatabase(object):
+    def __init__(self, entries):
+        self.hash_map = FakeHashMap(entries)
+
+    def HashMap(self):
+        return self.hash_map
+
+
+class OrderIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.folder, "orders.json")
+
+    def tearDown(self):
+        OrderIndex._orders.pop(self.file_path, None)
+        shutil.rmtree(self.folder)
+
+    def test_migration_moves_only_orders(self):
+        listing = DATA_FOLDER + "store/contracts/listings/listing.json"
+        image = DATA_FOLDER + "store/media/" + "a" * 40
+        entries = {
+            "1" * 40: listing,
+            "2" * 40: image,
+            "3" * 40: order_path("3" * 40, True, "unfunded"),
+            "4" * 40: order_path("4" * 40, False, "in progress"),
+            "5" * 40: order_path("5" * 40, False, "trade receipts")
+        }
+        db = FakeDatabase(dict(entries))
+        index = OrderIndex(db, file_path=self.file_path)
+
+        self.assertEqual(db.hash_map.entries, {"1" * 40: listing, "2" * 40: image})
+        for order_id in ("3" * 40, "4" * 40, "5" * 40):
+            self.assertEqual(index.get_file(order_id), entries[order_id])
+        self.assertEqual(index.get_state("4" * 40), (False, "in progress"))
+        self.assertIsNone(index.orders.get("1" * 40))
+        self.assertTrue(os.path.isfile(self.file_path))
+
+    def test_migration_runs_once(self):
+        OrderIndex(FakeDatabase({}), file_path=self.file_path)
+        OrderIndex._orders.pop(self.file_path)
+        db = FakeDatabase({"3" * 40: order_path("3" * 40, True, "unfunded")})
+        index = OrderIndex(db, file_path=self.file_path)
+        self.assertEqual(index.orders, {})
+        self.assertEqual(len(db.hash_map.entries), 1)
+
+    def test_listings_moved_by_earlier_migration_are_restored(self):
+        listing = DATA_FOLDER + "store/contracts/listings/listing.json"
+        order = order_path("3" * 40, True, "unfunded")
+        with open(self.file_path, 'w') as outfile:
+            json.dump({"1" * 40: listing, "3" * 40: order}, outfile)
+        db = FakeDatabase({})
+        index = OrderIndex(db, file_path=self.file_path)
+        self.assertEqual(db.hash_map.entries, {"1" * 40: listing})
+        self.assertEqual(index.orders, {"3" * 40: order})
+        with open(self.file_path, 'r') as infile:
+            self.assertEqual(json.load(infile), {"3" * 40: order})
@@ -0,0 +1,41 @@
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# The longest side, in pixels, of each thumbnail made from an uploaded image.
+THUMBNAIL_SIZES = {"small": 120, "medium": 360, "large": 720}
+
+
+def thumbnail_key(image_hash, size):
+    """
+    The `HashMap` key a thumbnail of the image is stored under.
+    """
+    return "%s:%s" % (image_hash, size)
+
+
+def make_thumbnails(image_path, thumbnail_path):
+    """
+    Writes a jpeg of each size in `THUMBNAIL_SIZES` to `thumbnail_path` followed by
+    `_<size>`, skipping sizes the image is already smaller than. This is CPU heavy so
+    it's meant to be run in a worker process (see `restapi.process_map`).
+    Returns: a list of (size, file path) tuples for the thumbnails written. Empty if
+        PIL isn't installed or the image can't be decoded.
+    """
+    if Image is None:
+        return []
+    try:
+        original = Image.open(image_path)
+        original.load()
+    except Exception:
+        return []
+    thumbnails = []
+    for size, pixels in sorted(THUMBNAIL_SIZES.items(), key=lambda s: s[1]):
+        if max(original.size) <= pixels:
+            break
+        thumbnail = original.convert("RGB")
+        thumbnail.thumbnail((pixels, pixels), Image.ANTIALIAS)
+        file_path = "%s_%s" % (thumbnail_path, size)
+        thumbnail.save(file_path, "JPEG", quality=85)
+        thumbnails.append((size, file_path))
+    return thumbnails